@@ -0,0 +1,301 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import click
+import numpy as np
+
+from . import draw_utils
+from . import result_io
+from .blind import Drawer, StyleDrawer, load_style_config
+from .cache import DetectionCache
+from .devices import configure_threads, device_options
+from .results import clean_records
+from .yolo import Detector, check_precision
+
+
+VIDEO_SUFFIXES = (".mp4", ".mov", ".mkv", ".avi", ".m4v", ".webm")
+
+# ワーカープロセスごとに 1 つだけ持つ検出器
+_detector = None
+
+
+def _init_worker(detector_kwargs, num_threads):
+    global _detector
+    configure_threads(num_threads)
+    _detector = Detector(**detector_kwargs)
+
+
+def _process(video_path, output_video_path, styles, clean_kwargs, use_cache, workers):
+    """1 本の動画に predict -> clean -> blind を行う。中間ファイルはジョブ専用の一時ディレクトリに置く"""
+    job_dir = tempfile.mkdtemp(prefix="yth-batch-")
+    try:
+        result_path = os.path.join(job_dir, "results.npy")
+        _detector.run(
+                video_path, result_path,
+                cache=DetectionCache() if use_cache else None)
+
+        cleaned_path = os.path.join(job_dir, "cleaned.npy")
+        records = clean_records(np.array(result_io.load(result_path)), **clean_kwargs)
+        result_io.write(cleaned_path, records, result_io.read_meta(result_path))
+
+        # 書きかけの動画が出力先に現れないよう、一時ディレクトリで作ってから移す
+        tmp_output_path = os.path.join(job_dir, "output.mp4")
+        param = Drawer.Param(
+                video_path=video_path,
+                result_path=cleaned_path,
+                output_video_path=tmp_output_path,
+                targets=sorted({t for pargs in styles for t in pargs["targets"]}),
+                show_once=False,
+                with_audio=True,
+                workers=workers)
+        StyleDrawer(param, styles).run()
+        shutil.move(tmp_output_path, output_video_path)
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    return output_video_path
+
+
+def collect_inputs(source):
+    """ディレクトリなら直下の動画、それ以外は 1 行 1 パスのマニフェストとして読む"""
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(source, name) for name in os.listdir(source)
+            if name.lower().endswith(VIDEO_SUFFIXES))
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source) as f:
+        lines = [line.strip() for line in f]
+    return [
+        os.path.join(base, line) for line in lines
+        if line and not line.startswith("#")]
+
+
+def _output_path(video_path, output_dir, suffix):
+    stem = os.path.splitext(os.path.basename(video_path))[0]
+    return os.path.join(output_dir, f"{stem}{suffix}.mp4")
+
+
+def _is_output(video_path, output_dir, suffix, source_dir):
+    """このバッチの出力らしいファイルか
+
+    出力先が入力と同じディレクトリでも自分の出力を拾い直さないよう、suffix で
+    終わる名前は除く。出力先が入力と別なら、出力先の下にあるものはすべて除く
+    """
+    stem = os.path.splitext(os.path.basename(video_path))[0]
+    if stem.endswith(suffix):
+        return True
+    output_dir = os.path.abspath(output_dir)
+    return output_dir != os.path.abspath(source_dir) \
+        and os.path.abspath(video_path).startswith(os.path.join(output_dir, ""))
+
+
+def _find_collisions(video_paths, output_dir, suffix):
+    """同じ出力先になる入力を {出力先: [入力, ...]} で返す"""
+    by_output = dict()
+    for video_path in video_paths:
+        output_path = _output_path(video_path, output_dir, suffix)
+        by_output.setdefault(output_path, set()).add(os.path.abspath(video_path))
+    return {k: sorted(v) for k, v in by_output.items() if len(v) > 1}
+
+
+class Runner():
+    """ワーカープールにジョブを投げ、終わったものから結果を報告する"""
+
+    def __init__(self, options, source_dir):
+        check_precision(options["export"], options["precision"])
+        self.o = options
+        self._source_dir = source_dir
+        if options["config_path"] is None:
+            if options["style"] == "image" and options["image_path"] is None:
+                raise click.BadParameter(
+                    "--style image needs --image-path", param_hint="--image-path")
+            styles = [dict(style=options["style"])]
+            if options["style"] == "image":
+                styles[0]["draw_image"] = options["image_path"]
+        else:
+            styles = load_style_config(options["config_path"])
+        self._styles = [
+            dict(pargs, targets=pargs.get("targets", list(options["targets"])))
+            for pargs in styles]
+        self._clean_kwargs = dict(
+                min_conf=options["min_conf"],
+                nms_iou=options["nms_iou"],
+                min_track_len=options["min_track_len"],
+                max_gap=options["max_gap"],
+                smooth_window=options["smooth_window"])
+        detector_kwargs = dict(
+                model_name=options["model_name"],
+                device=options["device"],
+                export=options["export"],
+                precision=options["precision"],
+                batch=options["batch"],
+                track=options["track"],
+                detect_every=options["detect_every"],
+                decode_width=options["decode_width"])
+        os.makedirs(options["output_dir"], exist_ok=True)
+        # CUDA を子プロセスで使えるよう fork ではなく spawn で起動する
+        self._executor = ProcessPoolExecutor(
+                max_workers=options["jobs"],
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(detector_kwargs, options["num_threads"]))
+        self._futures = dict()
+        # 出力先 -> 入力。別の入力が同じ出力先を上書きしないようにする
+        self._claimed = dict()
+        self.failed = list()
+        self.done = list()
+
+    def submit(self, video_path):
+        if _is_output(video_path, self.o["output_dir"], self.o["suffix"], self._source_dir):
+            print(f"skip {video_path}, looks like an output of this batch")
+            return False
+        output_video_path = _output_path(video_path, self.o["output_dir"], self.o["suffix"])
+        claimed = self._claimed.setdefault(output_video_path, os.path.abspath(video_path))
+        if claimed != os.path.abspath(video_path):
+            print(f"failed {video_path}: {output_video_path} is already the output of {claimed}")
+            self.failed.append(video_path)
+            return False
+        if os.path.exists(output_video_path) and not self.o["overwrite"]:
+            print(f"skip {video_path}, {output_video_path} exists")
+            return False
+        future = self._executor.submit(
+                _process, video_path, output_video_path, self._styles,
+                self._clean_kwargs, self.o["use_cache"], self.o["draw_workers"])
+        self._futures[future] = video_path
+        return True
+
+    def poll(self, timeout=None):
+        """終わったジョブを回収する。timeout=None なら全ジョブの終了を待つ"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._futures:
+            finished = [f for f in self._futures if f.done()]
+            if not finished:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                time.sleep(0.2)
+                continue
+            for future in finished:
+                video_path = self._futures.pop(future)
+                try:
+                    print(f"done {video_path} -> {future.result()}")
+                    self.done.append(video_path)
+                except Exception as e:
+                    print(f"failed {video_path}: {e!r}")
+                    self.failed.append(video_path)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+@click.group()
+def batch():
+    pass
+
+
+def _batch_options(f):
+    options = [
+        click.option("--output-dir", type=str, required=True),
+        click.option("--suffix", type=str, default="-blind", help="appended to output file names"),
+        click.option("--overwrite", is_flag=True, default=False),
+        click.option("--jobs", type=int, default=2, help="worker processes, each loads the model once"),
+        click.option("--draw-workers", type=int, default=0, help="draw threads per job"),
+        click.option("--model-name", type=str, default="yolov8s.pt"),
+        click.option("--batch", type=int, default=8, help="frames per inference batch"),
+        device_options,
+        click.option("--export", type=click.Choice(["none", "onnx", "openvino"]), default="none"),
+        click.option(
+            "--precision", type=click.Choice(["auto", "fp32", "fp16", "int8"]), default="auto"),
+        click.option("--cache/--no-cache", "use_cache", default=True),
+        click.option("--track", is_flag=True, default=False),
+        click.option("--detect-every", type=int, default=1),
+        click.option("--decode-width", type=int, default=0),
+        click.option("--min-conf", type=float, default=0.25),
+        click.option("--nms-iou", type=float, default=0.5),
+        click.option("--min-track-len", type=int, default=5),
+        click.option("--max-gap", type=int, default=5),
+        click.option("--smooth-window", type=int, default=5),
+        click.option(
+            "--style", type=click.Choice(draw_utils.styles()), default="mosaic",
+            help="used when --config is not given"),
+        click.option(
+            "--image-path", type=str, default=None,
+            help="overlay image for --style image"),
+        click.option(
+            "--config", "config_path", type=str, default=None,
+            help="JSON style config, same format as `blind styles`"),
+        click.option("--targets", type=int, multiple=True, default=[0, 1, 2, 3]),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+@batch.command()
+@click.argument("source", type=str)
+@_batch_options
+def run(source, **options):
+    """Run predict -> clean -> blind on every video in a directory or manifest.
+
+    SOURCE is a directory (videos directly under it) or a text file
+    with one video path per line.
+    """
+    source_dir = source if os.path.isdir(source) else os.path.dirname(os.path.abspath(source))
+    video_paths = [
+        path for path in collect_inputs(source)
+        if not _is_output(path, options["output_dir"], options["suffix"], source_dir)]
+    collisions = _find_collisions(video_paths, options["output_dir"], options["suffix"])
+    if collisions:
+        raise click.ClickException("inputs with the same file name would overwrite each other: " + "; ".join(
+            f"{', '.join(inputs)} -> {output}" for output, inputs in collisions.items()))
+    print(f"{len(video_paths)} videos")
+    runner = Runner(options, source_dir)
+    try:
+        for video_path in video_paths:
+            runner.submit(video_path)
+        runner.poll()
+    finally:
+        runner.shutdown()
+    print(f"{len(runner.done)} done, {len(runner.failed)} failed")
+    if runner.failed:
+        raise click.ClickException(f"failed: {', '.join(runner.failed)}")
+
+
+@batch.command()
+@click.argument("source_dir", type=str)
+@click.option("--interval", type=float, default=10., help="seconds between directory scans")
+@_batch_options
+def watch(source_dir, interval, **options):
+    """Process videos as they appear in SOURCE_DIR until interrupted.
+
+    A file is picked up once its size and mtime are unchanged between two scans.
+    """
+    runner = Runner(options, source_dir)
+    seen = dict()
+    submitted = set()
+    try:
+        while True:
+            for video_path in collect_inputs(source_dir):
+                if video_path in submitted:
+                    continue
+                try:
+                    stat = os.stat(video_path)
+                except FileNotFoundError:
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                # コピー途中のファイルを拾わないよう、前回の走査から変化がないものだけ処理する
+                if seen.get(video_path) == signature:
+                    submitted.add(video_path)
+                    runner.submit(video_path)
+                else:
+                    seen[video_path] = signature
+            runner.poll(timeout=0)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("stop watching, waiting for running jobs...")
+    finally:
+        runner.poll()
+        runner.shutdown()
+    print(f"{len(runner.done)} done, {len(runner.failed)} failed")
@@ -1,11 +1,27 @@
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from functools import partial
+import json
+import os
+import queue
+import subprocess
+import tempfile
+import threading
 
 import click
 import cv2
+import ffmpeg
 import moviepy.editor as mp
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
 
+from . import result_io
+from .cache import DetectionCache
+from . import draw_utils
+from .media import probe_keyframes
+
 
 @dataclass
 class VideoInfo:
@@ -24,6 +40,145 @@ def get_video_info(video):
     return VideoInfo(width, height, fps, frame_num)
 
 
+def load_results(result_path, info: VideoInfo, frame_range=None):
+    """検出結果を読み込み、検出時と解像度が違う場合は座標を合わせる
+
+    frame_range=(start, end) を与えた場合は frame_id 順に並んだバイナリ形式から
+    その範囲の行だけを読む (prepare_results を参照)
+    """
+    if frame_range is None:
+        results = result_io.read(result_path)
+    else:
+        results = result_io.read_range(result_path, *frame_range)
+    source_size = result_io.read_meta(result_path).get("source_size")
+    if source_size is None or source_size == [info.width, info.height]:
+        return results
+    sx = info.width / source_size[0]
+    sy = info.height / source_size[1]
+    print(f"rescale boxes from {source_size} to ({info.width}, {info.height})")
+    results[["x1", "x2"]] *= sx
+    results[["y1", "y2"]] *= sy
+    return results
+
+
+class FrameIndex():
+    """frame_id ごとの検出結果を O(1) で引くための索引
+
+    結果を frame_id で安定ソートしておき、各フレームの開始位置を
+    オフセット配列として持つ
+    """
+
+    def __init__(self, results: pd.DataFrame):
+        frame_ids = results["frame_id"].to_numpy()
+        order = np.argsort(frame_ids, kind="stable")
+        self._results = results.iloc[order].reset_index(drop=True)
+
+        frame_ids = frame_ids[order]
+        frame_num = int(frame_ids[-1]) + 1 if len(frame_ids) else 0
+        counts = np.bincount(frame_ids, minlength=frame_num) \
+            if frame_num else np.zeros(0, dtype=np.int64)
+        self._offsets = np.zeros(frame_num + 1, dtype=np.int64)
+        np.cumsum(counts, out=self._offsets[1:])
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def get(self, frame_id):
+        if frame_id < 0 or frame_id >= len(self):
+            return self._results.iloc[0:0]
+        begin = self._offsets[frame_id]
+        end = self._offsets[frame_id + 1]
+        return self._results.iloc[begin:end]
+
+
+# 拡張子ごとに音声をコピーのまま入れられるコーデック。ここに無い組み合わせは aac に変換する
+_COPYABLE_AUDIO = {
+    ".mp4": {"aac", "mp3", "ac3", "eac3", "alac"},
+    ".m4v": {"aac", "mp3", "ac3", "eac3", "alac"},
+    ".mov": {"aac", "mp3", "ac3", "eac3", "alac", "pcm_s16le", "pcm_s24le"},
+}
+
+
+def _audio_codec_for(audio_source, output_video_path):
+    ext = os.path.splitext(output_video_path)[1].lower()
+    if ext not in _COPYABLE_AUDIO:
+        return "copy"
+    streams = ffmpeg.probe(audio_source, select_streams="a")["streams"]
+    if all(s.get("codec_name") in _COPYABLE_AUDIO[ext] for s in streams):
+        return "copy"
+    print(f"re-encode audio to aac, {ext} cannot hold {[s.get('codec_name') for s in streams]}")
+    return "aac"
+
+
+class FFmpegWriter():
+    """生のフレームを ffmpeg に流し込んで 1 パスでエンコードする
+
+    audio_source を与えた場合は元動画の音声ストリームを再エンコードせずに
+    そのまま多重化する。出力先に入らないコーデックの場合は aac に変換する
+    """
+
+    def __init__(
+            self,
+            output_video_path,
+            info: VideoInfo,
+            audio_source=None,
+            vcodec="libx264",
+            encoder_args=None):
+        video = ffmpeg.input(
+                "pipe:",
+                format="rawvideo",
+                pix_fmt="bgr24",
+                s=f"{info.width}x{info.height}",
+                r=info.fps)
+        streams = [video]
+        kwargs = dict(vcodec=vcodec, pix_fmt="yuv420p")
+        kwargs.update(encoder_args or {})
+        if audio_source is not None:
+            # 音声トラックが無い動画でも失敗しないように任意指定にする
+            streams.append(ffmpeg.input(audio_source)["a?"])
+            kwargs["acodec"] = _audio_codec_for(audio_source, output_video_path)
+        cmd = (
+            ffmpeg
+            .output(*streams, output_video_path, **kwargs)
+            .overwrite_output()
+            .global_args("-loglevel", "error")
+            .compile()
+        )
+        # エラー内容を失敗時に表示できるよう stderr はファイルに受ける
+        self._log = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stderr=self._log)
+
+    def isOpened(self):
+        return self._process.poll() is None
+
+    def write(self, img):
+        try:
+            self._process.stdin.write(
+                    np.ascontiguousarray(img).tobytes())
+        except BrokenPipeError:
+            self._process.wait()
+            self._raise()
+
+    def release(self):
+        if self._process.stdin.closed:
+            return
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self._process.wait() != 0:
+            self._raise()
+        self._log.close()
+
+    def _raise(self):
+        self._log.seek(0)
+        message = self._log.read().decode(errors="replace").strip()
+        self._log.close()
+        raise RuntimeError(
+            f"ffmpeg exited with code {self._process.returncode}: {message}")
+
+
 class Drawer():
 
     @dataclass
@@ -34,7 +189,15 @@ class Drawer():
         targets: list
         show_once: bool
         with_audio: bool
-        tmp_video_path: str
+        tmp_video_path: str = None
+        writer: str = "ffmpeg"
+        workers: int = 0
+        start_frame: int = 0
+        end_frame: int = None
+        # 結果が frame_id 順のバイナリ形式なら範囲の行だけを読む
+        sorted_results: bool = False
+        # ffmpeg の出力オプションの追加分 (smart render で元の profile などに合わせる)
+        encoder_args: dict = None
 
     def __init__(
             self,
@@ -46,14 +209,36 @@ class Drawer():
         print(
             f"size: ({self._info.width}, {self._info.height}), "
             f"fps: {self._info.fps:1.2f}, num: {self._info.frame_num}")
-        self._results = pd.read_csv(self.p.result_path, header=0)
-
-        fmt = cv2.VideoWriter_fourcc(*"mp4v")
-        self._writer = cv2.VideoWriter(
-                self.p.tmp_video_path,
-                fmt,
-                self._info.fps,
-                (self._info.width, self._info.height))
+        self._end_frame = self._info.frame_num if self.p.end_frame is None \
+            else min(self.p.end_frame, self._info.frame_num)
+        if self.p.start_frame > 0:
+            self._video.set(cv2.CAP_PROP_POS_FRAMES, self.p.start_frame)
+        frame_range = (self.p.start_frame, self._end_frame) \
+            if self.p.sorted_results else None
+        self._results = FrameIndex(
+                load_results(self.p.result_path, self._info, frame_range))
+
+        if self.p.show_once:
+            # 確認用に 1 枚表示するだけなので、出力先を作らない (既存のファイルを壊さない)
+            self._writer = None
+            return
+        if self.p.writer == "ffmpeg":
+            self._writer = FFmpegWriter(
+                    self.p.output_video_path,
+                    self._info,
+                    audio_source=self.p.video_path if self.p.with_audio else None,
+                    encoder_args=self.p.encoder_args)
+        else:
+            # 中間ファイルはジョブごとの一時ディレクトリに置き、並行実行で衝突させない
+            self._tmp_dir = tempfile.TemporaryDirectory(prefix="yth-blind-")
+            self._tmp_video_path = self.p.tmp_video_path \
+                or os.path.join(self._tmp_dir.name, "video.mp4")
+            fmt = cv2.VideoWriter_fourcc(*"mp4v")
+            self._writer = cv2.VideoWriter(
+                    self._tmp_video_path,
+                    fmt,
+                    self._info.fps,
+                    (self._info.width, self._info.height))
         if not self._writer.isOpened():
             print("failed to create a writer")
             return
@@ -64,43 +249,95 @@ class Drawer():
 
     def run(self):
         print("try to process all frames...")
-        for frame_id in tqdm(range(self._info.frame_num)):
-            ret, img = self._video.read()
-            if not ret:
-                print(f"failed to read image[{frame_id}]")
-                break
-            result = self._results[self._results["frame_id"] == frame_id]
-            if not result.empty:
-                img = self._draw_impl(img, result)
-                if self.p.show_once:
-                    import matplotlib.pyplot as plt
-                    plt.imshow(img)
-                    plt.show()
-                    return
-
-            self._writer.write(img)
+        if self.p.workers > 0 and not self.p.show_once:
+            self._run_pipelined()
+        else:
+            for frame_id in tqdm(range(self.p.start_frame, self._end_frame)):
+                ret, img = self._video.read()
+                if not ret:
+                    print(f"failed to read image[{frame_id}]")
+                    break
+                result = self._results.get(frame_id)
+                if not result.empty:
+                    img = self._draw_impl(img, result)
+                    if self.p.show_once:
+                        import matplotlib.pyplot as plt
+                        plt.imshow(img)
+                        plt.show()
+                        break
+
+                if self._writer is not None:
+                    self._writer.write(img)
 
         self._video.release()
+        if self._writer is None:
+            return
         self._writer.release()
 
+        if self.p.writer == "ffmpeg":
+            # 音声の多重化まで ffmpeg 側で済んでいる
+            return
         if self.p.with_audio:
+            audio_path = os.path.join(self._tmp_dir.name, "audio.mp3")
             clip_input = mp.VideoFileClip(self.p.video_path)
-            clip_input.audio.write_audiofile("/tmp/audio.mp3")
-            clip = mp.VideoFileClip(self.p.tmp_video_path)
-            audio = mp.AudioFileClip("/tmp/audio.mp3")
+            clip_input.audio.write_audiofile(audio_path)
+            clip = mp.VideoFileClip(self._tmp_video_path)
+            audio = mp.AudioFileClip(audio_path)
             clip = clip.set_audio(audio)
             clip.write_videofile(
                     self.p.output_video_path,
                     codec='libx264',
                     audio_codec='aac',
-                    temp_audiofile='temp-audio.m4a',
+                    temp_audiofile=os.path.join(self._tmp_dir.name, "temp-audio.m4a"),
                     remove_temp=True)
         else:
-            clip = mp.VideoFileClip(self.p.tmp_video_path)
+            clip = mp.VideoFileClip(self._tmp_video_path)
             clip.write_videofile(
                     self.p.output_video_path,
                     codec='libx264',
                     remove_temp=True)
+        self._tmp_dir.cleanup()
+
+    def _process_frame(self, frame_id, img):
+        result = self._results.get(frame_id)
+        if not result.empty:
+            img = self._draw_impl(img, result)
+        return img
+
+    def _run_pipelined(self):
+        # 読み込み -> 描画 (workers 並列) -> 書き込み のパイプライン
+        # キューと未完了タスク数に上限を設けてメモリ使用量を抑える
+        depth = self.p.workers * 2
+        frames = queue.Queue(maxsize=depth)
+
+        def read():
+            for frame_id in range(self.p.start_frame, self._end_frame):
+                ret, img = self._video.read()
+                if not ret:
+                    print(f"failed to read image[{frame_id}]")
+                    break
+                frames.put((frame_id, img))
+            frames.put(None)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+
+        # 投入順に結果を取り出して書き込むことでフレーム順を保つ
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.p.workers) as executor, \
+                tqdm(total=self._end_frame - self.p.start_frame) as bar:
+            while True:
+                item = frames.get()
+                if item is None:
+                    break
+                pending.append(executor.submit(self._process_frame, *item))
+                if len(pending) >= depth:
+                    self._writer.write(pending.popleft().result())
+                    bar.update()
+            while pending:
+                self._writer.write(pending.popleft().result())
+                bar.update()
+        reader.join()
 
     def _draw_impl(self, img, result):
         raise NotImplementedError("not implemented")
@@ -113,14 +350,7 @@ class RectDrawer(Drawer):
         super().__init__(param)
 
     def _draw_impl(self, img, result):
-        for r in result.itertuples():
-            if r.cls not in self.p.targets:
-                continue
-            p1 = (round(r.x1), round(r.y1))
-            p2 = (round(r.x2), round(r.y2))
-            color = (255, 0, 0)
-            cv2.rectangle(img, p1, p2, color, 2)
-        return img
+        return draw_utils.call("rect", img, result, self.p.targets, dict())
 
 
 class ImageDrawer(Drawer):
@@ -130,43 +360,11 @@ class ImageDrawer(Drawer):
             image_path):
         super().__init__(param)
 
-        # アルファ値込みで使いたい
-        self._overlay_img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+        self._pargs = dict(draw_image=image_path)
+        draw_utils.load_overlay(image_path)
 
     def _draw_impl(self, img, result):
-        widths = result["x2"] - result["x1"]
-        heights = result["y2"] - result["y1"]
-        rs = result.copy()
-        rs["largeness"] = widths * heights
-        rs = rs.sort_values(by="largeness", ascending=True)
-
-        for r in rs.itertuples():
-            if r.cls not in self.p.targets:
-                continue
-            # 描画領域の左上と右下座標
-            rect_width = round(r.x2) - round(r.x1)
-            rect_height = round(r.y2) - round(r.y1)
-
-            resized_overlay = cv2.resize(
-                    self._overlay_img,
-                    (rect_width, rect_height))
-
-            overlay_bgr = resized_overlay[:, :, :3]  # BGRチャンネル
-            overlay_alpha = resized_overlay[:, :, 3]  # アルファチャンネル
-            # アルファ値を0-1に正規化
-            overlay_alpha = overlay_alpha / 255.0
-
-            # 矩形範囲内の背景画像部分を取り出す
-            background_region = img[round(r.y1):round(r.y2), round(r.x1):round(r.x2)]
-
-            # アルファチャンネルを使って背景とオーバーレイ画像をブレンド
-            for c in range(0, 3):  # 各カラー（BGR）チャンネルで合成
-                background_region[:, :, c] = overlay_alpha * overlay_bgr[:, :, c] + (1 - overlay_alpha) * background_region[:, :, c]
-
-                # 合成結果を元の背景画像に適用
-                img[round(r.y1):round(r.y2), round(r.x1):round(r.x2)] = background_region
-
-        return img
+        return draw_utils.call("image", img, result, self.p.targets, self._pargs)
 
 
 class GaussianDrawer(Drawer):
@@ -175,22 +373,11 @@ class GaussianDrawer(Drawer):
             param: Drawer.Param,
             kernel_size):
         super().__init__(param)
-        self._kernel_size = kernel_size
+        self._pargs = dict(kernel_size=kernel_size)
 
 
     def _draw_impl(self, img, results):
-        for r in results.itertuples():
-            if r.cls not in self.p.targets:
-                continue
-            x = round((r.x1 + r.x2) / 2.)
-            y = round((r.y1 + r.y2) / 2.)
-            hw = round((r.x2 - r.x1) / 2.)
-            hh = round((r.y2 - r.y1) / 2.)
-
-            roi = img[y-hh:y+hh, x-hw:x+hw]
-            blurred_roi = cv2.GaussianBlur(roi, [self._kernel_size, self._kernel_size], 0)
-            img[y-hh:y+hh, x-hw:x+hw] = blurred_roi
-        return img
+        return draw_utils.call("blur", img, results, self.p.targets, self._pargs)
 
 
 class MosaicDrawer(Drawer):
@@ -199,146 +386,382 @@ class MosaicDrawer(Drawer):
             param: Drawer.Param,
             scale):
         super().__init__(param)
-        self._scale = scale
+        self._pargs = dict(scale=scale)
 
 
     def _draw_impl(self, img, results):
-        for r in results.itertuples():
-            if r.cls not in self.p.targets:
-                continue
-            x = round((r.x1 + r.x2) / 2.)
-            y = round((r.y1 + r.y2) / 2.)
-            hw = round((r.x2 - r.x1) / 2.)
-            hh = round((r.y2 - r.y1) / 2.)
-
-            roi = img[y-hh:y+hh, x-hw:x+hw]
-
-            w = roi.shape[1]
-            h = roi.shape[0]
-            roi = cv2.resize(
-                    roi,
-                    (int(w / self._scale), int(h / self._scale)))
-            roi = cv2.resize(
-                    roi,
-                    (w, h),
-                    interpolation=cv2.INTER_NEAREST)
-            img[y-hh:y+hh, x-hw:x+hw] = roi
+        return draw_utils.call("mosaic", img, results, self.p.targets, self._pargs)
+
+
+class StyleDrawer(Drawer):
+    """複数のスタイルを 1 回のデコード・エンコードでまとめて描画する
+
+    styles は {"style": 名前, "targets": [クラス, ...], その他の引数} のリストで、
+    先頭から順に重ねて描画する。targets を省略した場合は Param の targets を使う
+    """
+
+    def __init__(
+            self,
+            param: Drawer.Param,
+            styles):
+        super().__init__(param)
+        self._styles = styles
+
+    def _draw_impl(self, img, results):
+        for pargs in self._styles:
+            img = draw_utils.call(
+                    pargs["style"],
+                    img,
+                    results,
+                    pargs.get("targets", self.p.targets),
+                    pargs)
         return img
 
 
+def load_style_config(config_path):
+    with open(config_path) as f:
+        config = json.load(f)
+    styles = config["styles"] if isinstance(config, dict) else config
+    for pargs in styles:
+        if pargs.get("style") not in draw_utils.styles():
+            raise ValueError(
+                f"unknown style {pargs.get('style')!r} in {config_path}, "
+                f"choose from {draw_utils.styles()}")
+        if pargs["style"] == "image" and "draw_image" not in pargs:
+            raise ValueError(f"style 'image' needs 'draw_image' in {config_path}")
+    return styles
+
+
+def split_at_keyframes(video_path, info: VideoInfo, chunk_num):
+    """動画をおおよそ等分する [start, end) のフレーム範囲に分割する
+
+    境界はキーフレームに揃えるので、各範囲は独立にシーク・デコードできる
+    """
+    keyframes = np.asarray(probe_keyframes(video_path, info.fps))
+    keyframes = keyframes[keyframes < info.frame_num]
+    targets = np.linspace(0, info.frame_num, chunk_num + 1)[1:-1]
+    nearest = np.abs(keyframes[None, :] - targets[:, None]).argmin(axis=1)
+    bounds = sorted({0, info.frame_num, *keyframes[nearest].tolist()})
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def concat_segments(segment_paths, output_video_path, audio_source=None):
+    """エンコード済みのセグメントを concat demuxer で無劣化に連結する"""
+    list_path = os.path.join(
+            os.path.dirname(segment_paths[0]), "segments.txt")
+    with open(list_path, "w") as f:
+        for path in segment_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+
+    cmd = ["ffmpeg", "-y", "-loglevel", "error",
+           "-f", "concat", "-safe", "0", "-i", list_path]
+    if audio_source is not None:
+        cmd += ["-i", audio_source, "-map", "0:v", "-map", "1:a?",
+                "-c:a", _audio_codec_for(audio_source, output_video_path)]
+    cmd += ["-c:v", "copy", output_video_path]
+    subprocess.run(cmd, check=True)
+
+
+def prepare_results(result_path, tmp_dir):
+    """範囲読み込みできるよう、frame_id 順のバイナリ形式の結果ファイルを用意する
+
+    既にそうなっていればそのまま返し、そうでなければ一度だけ並べ替えて tmp_dir に書く
+    """
+    if result_io.is_binary(result_path) and result_io.is_sorted(result_path):
+        return result_path
+    records = np.array(result_io.load(result_path))
+    records = records[np.argsort(records["frame_id"], kind="stable")]
+    sorted_path = os.path.join(tmp_dir, "results.npy")
+    result_io.write(sorted_path, records, result_io.read_meta(result_path))
+    return sorted_path
+
+
+def _run_chunk(factory, param):
+    factory(param).run()
+    return param.output_video_path
+
+
+def run_chunked(factory, param: Drawer.Param, jobs):
+    """キーフレーム境界で区切った範囲を別プロセスで描画して連結する
+
+    factory は Drawer.Param を受け取って Drawer を返す呼び出し可能オブジェクト
+    (プロセス間で受け渡すため pickle できる必要がある)
+    """
+    video = cv2.VideoCapture(param.video_path)
+    info = get_video_info(video)
+    video.release()
+    chunks = split_at_keyframes(param.video_path, info, jobs)
+    print(f"split into {len(chunks)} chunks: {chunks}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_path = prepare_results(param.result_path, tmp_dir)
+        params = [
+            replace(
+                param,
+                result_path=result_path,
+                sorted_results=True,
+                output_video_path=os.path.join(tmp_dir, f"{i:05d}.mp4"),
+                with_audio=False,
+                show_once=False,
+                writer="ffmpeg",
+                start_frame=start,
+                end_frame=end)
+            for i, (start, end) in enumerate(chunks)
+            ]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            segment_paths = list(executor.map(
+                partial(_run_chunk, factory), params))
+
+        concat_segments(
+                segment_paths,
+                param.output_video_path,
+                audio_source=param.video_path if param.with_audio else None)
+
+
+def _probe_video_stream(video_path):
+    probe = ffmpeg.probe(video_path, select_streams="v:0")
+    return probe["streams"][0]
+
+
+def plan_smart_render(video_path, info: VideoInfo, results, targets):
+    """GOP 単位で描画が必要な範囲とそうでない範囲に分ける
+
+    (start, end, needs_draw) のリストを返す。隣り合う同じ種類の GOP はまとめる
+    """
+    keyframes = [k for k in probe_keyframes(video_path, info.fps) if k < info.frame_num]
+    bounds = np.asarray(keyframes + [info.frame_num])
+    frames = np.unique(
+            results.loc[results["cls"].isin(targets), "frame_id"].to_numpy())
+    hits = np.searchsorted(frames, bounds[1:]) - np.searchsorted(frames, bounds[:-1])
+
+    segments = list()
+    for start, end, needs_draw in zip(bounds[:-1], bounds[1:], hits > 0):
+        if segments and segments[-1][2] == needs_draw:
+            segments[-1] = (segments[-1][0], int(end), bool(needs_draw))
+        else:
+            segments.append((int(start), int(end), bool(needs_draw)))
+    return segments
+
+
+def _copy_segment(video_path, fps, start, end, output_path):
+    # キーフレームから始まる範囲を再エンコードせずに切り出す
+    # (丸め誤差で 1 つ前のキーフレームに戻らないよう半フレーム後ろを指定する。
+    # 入力側の -ss は start_time からの相対時刻なので start_time は足さない)
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error",
+         "-ss", f"{(start + 0.5) / fps:.6f}",
+         "-i", video_path,
+         "-map", "0:v:0", "-frames:v", str(end - start),
+         "-c", "copy", "-bsf:v", "h264_mp4toannexb", "-f", "mpegts",
+         output_path],
+        check=True)
+    return output_path
+
+
+# ffprobe の profile 名から libx264 の profile 名へ
+_X264_PROFILES = {
+    "Constrained Baseline": "baseline",
+    "Baseline": "baseline",
+    "Main": "main",
+    "High": "high",
+}
+
+
+def _smart_encoder_args(stream):
+    """元の H.264 ストリームに継ぎ足せるエンコード設定を返す。合わせられなければ None
+
+    libx264 で作る GOP の SPS を元と揃えないと、厳格なプレーヤーでは
+    途中から正しく再生できない
+    """
+    if stream.get("codec_name") != "h264":
+        return None
+    pix_fmt = stream.get("pix_fmt")
+    profile = _X264_PROFILES.get(stream.get("profile"))
+    level = stream.get("level")
+    # 10 bit や 4:2:2 / 4:4:4、インターレースは libx264 の 8 bit 4:2:0 では合わせられない
+    if pix_fmt not in ("yuv420p", "yuvj420p") or profile is None \
+            or not level or level < 0 \
+            or stream.get("field_order", "progressive") not in ("progressive", "unknown"):
+        return None
+    args = {"pix_fmt": pix_fmt, "profile:v": profile, "level": f"{level / 10:.1f}"}
+    for key in ["color_range", "color_primaries", "color_trc", "colorspace"]:
+        value = stream.get(key)
+        if value and value != "unknown":
+            args[key] = value
+    return args
+
+
+def run_smart(factory, param: Drawer.Param, jobs):
+    """検出の無い GOP はストリームコピーし、描画が必要な GOP だけ再エンコードする"""
+    stream = _probe_video_stream(param.video_path)
+    encoder_args = _smart_encoder_args(stream)
+    if encoder_args is None:
+        print(
+            "smart render needs 8 bit 4:2:0 progressive h264 "
+            f"(baseline/main/high), got {stream.get('codec_name')} "
+            f"{stream.get('profile')} {stream.get('pix_fmt')}, render everything")
+        return _run(factory, param, jobs, smart_render=False)
+
+    video = cv2.VideoCapture(param.video_path)
+    info = get_video_info(video)
+    video.release()
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            ProcessPoolExecutor(max_workers=jobs) as executor:
+        result_path = prepare_results(param.result_path, tmp_dir)
+        segments = plan_smart_render(
+                param.video_path, info,
+                result_io.read(result_path), param.targets)
+        drawn = sum(end - start for start, end, needs_draw in segments if needs_draw)
+        print(f"{len(segments)} segments, re-encode {drawn}/{info.frame_num} frames")
+
+        # SPS/PPS を各セグメントに持たせるため MPEG-TS で切り出して連結する
+        futures = list()
+        for i, (start, end, needs_draw) in enumerate(segments):
+            path = os.path.join(tmp_dir, f"{i:05d}.ts")
+            if needs_draw:
+                futures.append(executor.submit(_run_chunk, factory, replace(
+                    param,
+                    result_path=result_path,
+                    sorted_results=True,
+                    encoder_args=encoder_args,
+                    output_video_path=path,
+                    with_audio=False,
+                    show_once=False,
+                    writer="ffmpeg",
+                    start_frame=start,
+                    end_frame=end)))
+            else:
+                futures.append(executor.submit(
+                    _copy_segment, param.video_path, info.fps,
+                    start, end, path))
+        segment_paths = [f.result() for f in futures]
+
+        concat_segments(
+                segment_paths,
+                param.output_video_path,
+                audio_source=param.video_path if param.with_audio else None)
+
+
+def _run(factory, param: Drawer.Param, jobs, smart_render=False):
+    if param.show_once:
+        factory(param).run()
+    elif smart_render:
+        run_smart(factory, param, jobs)
+    elif jobs > 1:
+        run_chunked(factory, param, jobs)
+    else:
+        factory(param).run()
+
+
 @click.group()
 def blind():
     pass
 
 
+def _drawer_options(f):
+    options = [
+        click.option(
+            "--result_path", type=str, default=None,
+            help="defaults to cached detections for the video, "
+                 "then /tmp/blindpy-yolo-results.npy"),
+        click.option("--output_video_path", type=str, default="/tmp/blindpy.mp4"),
+        click.option("--targets", type=list, default=[0, 1, 2, 3]),
+        click.option("--show-once", is_flag=True, default=False),
+        click.option("--with-audio", is_flag=True, default=True),
+        click.option(
+            "--writer", type=click.Choice(["ffmpeg", "opencv"]), default="ffmpeg",
+            help="ffmpeg: encode and mux audio in a single pass, "
+                 "opencv: legacy mp4v temp file + moviepy re-encode"),
+        click.option(
+            "--workers", type=int, default=0,
+            help="number of draw threads, 0 processes frames serially"),
+        click.option(
+            "--jobs", type=int, default=1,
+            help="number of processes, splits the video at keyframes if > 1"),
+        click.option(
+            "--smart-render", is_flag=True, default=False,
+            help="stream-copy GOPs without target detections (h264 input only)"),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def _resolve_result_path(video_path):
+    cached = DetectionCache().find(video_path)
+    if cached is not None:
+        print(f"use cached result {cached}")
+        return cached
+    return "/tmp/blindpy-yolo-results.npy"
+
+
+def _make_param(video_path, result_path, **kwargs):
+    if result_path is None:
+        result_path = _resolve_result_path(video_path)
+    return Drawer.Param(
+            video_path=video_path,
+            result_path=result_path,
+            **kwargs)
+
+
 @blind.command()
 @click.argument("video_path", type=str)
-@click.option("--result_path", type=str, default="/tmp/blindpy-yolo-results.txt")
-@click.option("--output_video_path", type=str, default="/tmp/blindpy.mp4")
-@click.option("--targets", type=list, default=[0, 1, 2, 3])
-@click.option("--show-once", is_flag=True, default=False)
-@click.option("--with-audio", is_flag=True, default=True)
-def rect(
-        video_path,
-        result_path,
-        output_video_path,
-        targets,
-        show_once,
-        with_audio):
-    drawer = RectDrawer(
-            Drawer.Param(
-                video_path=video_path,
-                result_path=result_path,
-                output_video_path=output_video_path,
-                targets=targets,
-                show_once=show_once,
-                with_audio=with_audio,
-                tmp_video_path="/tmp/tmp.mp4"))
-    drawer.run()
+@_drawer_options
+def rect(video_path, jobs, smart_render, **kwargs):
+    _run(RectDrawer, _make_param(video_path, **kwargs), jobs, smart_render)
 
 
 @blind.command()
 @click.argument("video_path", type=str)
 @click.argument("image_path", type=str)
-@click.option("--result_path", type=str, default="/tmp/blindpy-yolo-results.txt")
-@click.option("--output_video_path", type=str, default="/tmp/blindpy.mp4")
-@click.option("--targets", type=list, default=[0, 1, 2, 3])
-@click.option("--show-once", is_flag=True, default=False)
-@click.option("--with-audio", is_flag=True, default=True)
-def image(
-        video_path,
-        image_path,
-        result_path,
-        output_video_path,
-        targets,
-        show_once,
-        with_audio):
-    drawer = ImageDrawer(
-            Drawer.Param(
-                video_path=video_path,
-                result_path=result_path,
-                output_video_path=output_video_path,
-                targets=targets,
-                show_once=show_once,
-                with_audio=with_audio,
-                tmp_video_path="/tmp/tmp.mp4"),
-            image_path)
-    drawer.run()
+@_drawer_options
+def image(video_path, image_path, jobs, smart_render, **kwargs):
+    _run(
+        partial(ImageDrawer, image_path=image_path),
+        _make_param(video_path, **kwargs),
+        jobs,
+        smart_render)
 
 
 @blind.command()
 @click.argument("video_path", type=str)
-@click.option("--result_path", type=str, default="/tmp/blindpy-yolo-results.txt")
-@click.option("--output_video_path", type=str, default="/tmp/blindpy.mp4")
-@click.option("--targets", type=list, default=[0, 1, 2, 3])
-@click.option("--show-once", is_flag=True, default=False)
-@click.option("--with-audio", is_flag=True, default=True)
+@_drawer_options
 @click.option("--kernel-size", type=int, default=51)
-def blur(
-        video_path,
-        result_path,
-        output_video_path,
-        targets,
-        show_once,
-        with_audio,
-        kernel_size):
-    drawer = GaussianDrawer(
-            Drawer.Param(
-                video_path=video_path,
-                result_path=result_path,
-                output_video_path=output_video_path,
-                targets=targets,
-                show_once=show_once,
-                with_audio=with_audio,
-                tmp_video_path="/tmp/tmp.mp4"),
-            kernel_size)
-    drawer.run()
+def blur(video_path, kernel_size, jobs, smart_render, **kwargs):
+    _run(
+        partial(GaussianDrawer, kernel_size=kernel_size),
+        _make_param(video_path, **kwargs),
+        jobs,
+        smart_render)
 
 
 @blind.command()
 @click.argument("video_path", type=str)
-@click.option("--result_path", type=str, default="/tmp/blindpy-yolo-results.txt")
-@click.option("--output_video_path", type=str, default="/tmp/blindpy.mp4")
-@click.option("--targets", type=list, default=[0, 1, 2, 3])
-@click.option("--show-once", is_flag=True, default=False)
-@click.option("--with-audio", is_flag=True, default=True)
+@_drawer_options
 @click.option("--scale", type=int, default=50)
-def mosaic(
-        video_path,
-        result_path,
-        output_video_path,
-        targets,
-        show_once,
-        with_audio,
-        scale):
-    drawer = MosaicDrawer(
-            Drawer.Param(
-                video_path=video_path,
-                result_path=result_path,
-                output_video_path=output_video_path,
-                targets=targets,
-                show_once=show_once,
-                with_audio=with_audio,
-                tmp_video_path="/tmp/tmp.mp4"),
-            scale)
-    drawer.run()
+def mosaic(video_path, scale, jobs, smart_render, **kwargs):
+    _run(
+        partial(MosaicDrawer, scale=scale),
+        _make_param(video_path, **kwargs),
+        jobs,
+        smart_render)
+
+
+@blind.command()
+@click.argument("video_path", type=str)
+@click.argument("config_path", type=str)
+@_drawer_options
+def styles(video_path, config_path, jobs, smart_render, **kwargs):
+    """Apply several styles in one pass.
+
+    CONFIG_PATH is a JSON file such as
+    {"styles": [{"style": "mosaic", "targets": [0], "scale": 20},
+    {"style": "image", "targets": [2], "draw_image": "sticker.png"}]}
+    """
+    param = _make_param(video_path, **kwargs)
+    style_list = [
+        dict(pargs, targets=pargs.get("targets", param.targets))
+        for pargs in load_style_config(config_path)]
+    # どのスタイルかで描画対象になるクラスをまとめて対象とする
+    param.targets = sorted({t for pargs in style_list for t in pargs["targets"]})
+    _run(partial(StyleDrawer, styles=style_list), param, jobs, smart_render)
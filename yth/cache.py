@@ -0,0 +1,214 @@
+"""動画の内容ハッシュをキーにしたローカルキャッシュ"""
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from . import result_io
+
+
+_ROOT = os.environ.get(
+        "YTH_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "yth"))
+_MAX_BYTES = int(os.environ.get("YTH_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+_CHUNK_SIZE = 8 * 1024 ** 2
+
+
+def cache_dir(kind):
+    path = os.path.join(_ROOT, kind)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_hash(path):
+    """ファイル内容のハッシュ値を返す
+
+    大きな動画を毎回読まずに済むように、パス・サイズ・更新時刻ごとに覚えておく
+    """
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    memo_path = os.path.join(cache_dir("hashes"), "hashes.json")
+    memo = dict()
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+    if key in memo:
+        return memo[key]
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+            h.update(chunk)
+    memo[key] = h.hexdigest()
+
+    tmp_path = f"{memo_path}.{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump(memo, f)
+    os.replace(tmp_path, memo_path)
+    return memo[key]
+
+
+def params_hash(params):
+    text = json.dumps(params, sort_keys=True)
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+class DetectionCache():
+    """検出結果のキャッシュ
+
+    {動画のハッシュ}-{推論パラメータのハッシュ}.npy に結果を、同名の .json に
+    パラメータなどの情報を置く。容量を超えたら最終利用が古いものから消す
+    """
+
+    def __init__(self, max_bytes=_MAX_BYTES):
+        self._dir = cache_dir("detections")
+        self._max_bytes = max_bytes
+
+    def _path(self, video_hash, params):
+        return os.path.join(
+                self._dir, f"{video_hash}-{params_hash(params)}.npy")
+
+    def get(self, video_path, params):
+        path = self._path(file_hash(video_path), params)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        return path
+
+    def find(self, video_path):
+        """推論パラメータを問わず、動画に対して最後に使われた結果を返す"""
+        video_hash = file_hash(video_path)
+        candidates = [
+            e for e in self.entries() if e["name"].startswith(video_hash)]
+        if not candidates:
+            return None
+        path = max(candidates, key=lambda e: e["mtime"])["path"]
+        os.utime(path)
+        return path
+
+    def put(self, video_path, params, result_path):
+        path = self._path(file_hash(video_path), params)
+        shutil.copyfile(result_path, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        result_io.write_meta(path, result_io.read_meta(result_path))
+        meta = dict(
+                video_path=os.path.abspath(video_path),
+                params=params,
+                created=time.time())
+        with open(path[:-len(".npy")] + ".json", "w") as f:
+            json.dump(meta, f, indent=2)
+        self.prune()
+        return path
+
+    def entries(self):
+        entries = list()
+        for name in os.listdir(self._dir):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self._dir, name)
+            meta = dict()
+            meta_path = path[:-len(".npy")] + ".json"
+            if os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+            stat = os.stat(path)
+            entries.append(dict(
+                name=name,
+                path=path,
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                meta=meta))
+        return sorted(entries, key=lambda e: e["mtime"], reverse=True)
+
+    def prune(self, max_bytes=None):
+        """合計サイズが max_bytes 以下になるまで古いものから消す"""
+        if max_bytes is None:
+            max_bytes = self._max_bytes
+        removed = list()
+        entries = self.entries()
+        total = sum(e["size"] for e in entries)
+        for entry in reversed(entries):
+            if total <= max_bytes:
+                break
+            os.remove(entry["path"])
+            result_io.write_meta(entry["path"], None)
+            meta_path = entry["path"][:-len(".npy")] + ".json"
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            total -= entry["size"]
+            removed.append(entry)
+        return removed
+
+
+class TranscriptCache():
+    """文字起こしのチェックポイント
+
+    音声チャンクの PCM のハッシュとモデルなどのパラメータをキーに、チャンク内の
+    時刻のままセグメントを {PCM のハッシュ}-{パラメータのハッシュ}.json に置く。
+    中断後の再実行では終わったチャンクを読み直し、編集後の動画でも内容が
+    変わっていないチャンクは再計算しない。容量を超えたら最終利用が古いものから消す
+    """
+
+    def __init__(self, max_bytes=_MAX_BYTES):
+        self._dir = cache_dir("transcripts")
+        self._max_bytes = max_bytes
+
+    def key(self, audio, params):
+        h = hashlib.blake2b(audio.tobytes(), digest_size=16)
+        return f"{h.hexdigest()}-{params_hash(params)}"
+
+    def get(self, key):
+        path = os.path.join(self._dir, f"{key}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            segments = json.load(f)["segments"]
+        os.utime(path)
+        return segments
+
+    def put(self, key, segments, meta=None):
+        path = os.path.join(self._dir, f"{key}.json")
+        tmp_path = f"{path}.{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                dict(meta or {}, created=time.time(), segments=segments),
+                f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self.prune()
+        return path
+
+    def entries(self):
+        entries = list()
+        for name in os.listdir(self._dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self._dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # 他のプロセスが消した
+                continue
+            entries.append(dict(
+                name=name,
+                path=path,
+                size=stat.st_size,
+                mtime=stat.st_mtime))
+        return sorted(entries, key=lambda e: e["mtime"], reverse=True)
+
+    def prune(self, max_bytes=None):
+        """合計サイズが max_bytes 以下になるまで古いものから消す"""
+        if max_bytes is None:
+            max_bytes = self._max_bytes
+        removed = list()
+        entries = self.entries()
+        total = sum(e["size"] for e in entries)
+        for entry in reversed(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(entry["path"])
+            except FileNotFoundError:
+                pass
+            total -= entry["size"]
+            removed.append(entry)
+        return removed
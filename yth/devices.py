@@ -0,0 +1,48 @@
+import click
+import torch
+
+
+_DEVICES = ["auto", "cpu", "mps", "cuda"]
+
+
+def select_device(device, candidates=("mps", "cuda")):
+    """推論に使うデバイス名を返す
+
+    auto の場合は candidates の中で使えるものを順に探し、無ければ cpu にする
+    """
+    if device != "auto":
+        return device
+    available = {
+        "mps": torch.backends.mps.is_available(),
+        "cuda": torch.cuda.is_available(),
+        }
+    for candidate in candidates:
+        if available.get(candidate, False):
+            return candidate
+    return "cpu"
+
+
+_threads_configured = False
+
+
+def configure_threads(num_threads):
+    # 0 の場合は torch の既定値 (物理コア数) のまま
+    # set_num_interop_threads は並列処理が始まった後に呼ぶと例外になるので、
+    # 同じプロセスで 2 回目以降は何もしない
+    global _threads_configured
+    if num_threads > 0 and not _threads_configured:
+        torch.set_num_threads(num_threads)
+        torch.set_num_interop_threads(max(1, num_threads // 2))
+        _threads_configured = True
+
+
+def device_options(f):
+    options = [
+        click.option("--device", type=click.Choice(_DEVICES), default="auto"),
+        click.option(
+            "--num-threads", type=int, default=0,
+            help="torch intra-op threads on cpu, 0 keeps the default"),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
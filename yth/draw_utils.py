@@ -1,61 +1,216 @@
 from dataclasses import dataclass
+from functools import lru_cache, partial
 
 import cv2
+import numpy as np
 
 
-def draw_rect(img, result, targets, pargs):
-    for r in result.itertuples():
-        if r.cls not in targets:
+def target_boxes(result, targets):
+    """描画対象クラスの矩形を整数座標 (x1, y1, x2, y2) の配列で返す"""
+    rs = result[result["cls"].isin(targets)]
+    return np.round(rs[["x1", "y1", "x2", "y2"]].to_numpy()).astype(int)
+
+
+def clip_box(x1, y1, x2, y2, width, height):
+    """矩形を画像内に収める。はみ出した分を除いた矩形を返す"""
+    return max(x1, 0), max(y1, 0), min(x2, width), min(y2, height)
+
+
+def _size_buckets(boxes):
+    # 短辺を 2 の冪に切り下げた値でまとめる
+    sides = np.minimum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+    return 1 << np.floor(np.log2(np.maximum(sides, 1))).astype(int)
+
+
+def group_overlapping(boxes):
+    """重なり合う矩形をまとめ、グループごとのインデックス配列を返す"""
+    if len(boxes) == 0:
+        return []
+    x1, y1, x2, y2 = (boxes[:, i] for i in range(4))
+    overlap = (x1[:, None] < x2[None, :]) & (x1[None, :] < x2[:, None]) \
+        & (y1[:, None] < y2[None, :]) & (y1[None, :] < y2[:, None])
+    # 連結成分ごとに最小のインデックスをラベルとして伝播させる
+    labels = np.arange(len(boxes))
+    while True:
+        new_labels = np.where(overlap, labels[None, :], len(boxes)).min(axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+    return [np.flatnonzero(labels == label) for label in np.unique(labels)]
+
+
+def _apply_regions(img, boxes, process):
+    # 画像内に収めてから、重なった矩形は外接矩形ごとに 1 回だけ処理する
+    height, width = img.shape[:2]
+    boxes = boxes.copy()
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, width)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, height)
+    boxes = boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+
+    for indices in group_overlapping(boxes):
+        group = boxes[indices]
+        x1, y1 = group[:, :2].min(axis=0)
+        x2, y2 = group[:, 2:].max(axis=0)
+        roi = img[y1:y2, x1:x2]
+        processed = process(roi)
+        if len(group) == 1:
+            roi[...] = processed
             continue
-        p1 = (round(r.x1), round(r.y1))
-        p2 = (round(r.x2), round(r.y2))
-        color = (255, 0, 0)
-        cv2.rectangle(img, p1, p2, color, 2)
+        mask = np.zeros(roi.shape[:2], dtype=bool)
+        for bx1, by1, bx2, by2 in group - [x1, y1, x1, y1]:
+            mask[by1:by2, bx1:bx2] = True
+        np.copyto(roi, processed, where=mask[:, :, None])
     return img
 
 
-def draw_image(img, result, targets, pargs):
+def _fast_blur(roi, kernel_size):
+    # 縮小してからぼかして拡大する。縮小後のカーネルはほぼ一定の大きさになる
+    if kernel_size < 3:
+        return roi
+    height, width = roi.shape[:2]
+    factor = max(1, kernel_size // 9)
+    small = roi
+    if factor > 1:
+        small = cv2.resize(
+                roi,
+                (max(1, width // factor), max(1, height // factor)),
+                interpolation=cv2.INTER_AREA)
+    k = max(3, (kernel_size // factor) | 1)
+    small = cv2.GaussianBlur(small, (k, k), 0)
+    if factor > 1:
+        return cv2.resize(
+                small, (width, height), interpolation=cv2.INTER_LINEAR)
+    return small
+
+
+def _pixelate(roi, block):
+    height, width = roi.shape[:2]
+    small = cv2.resize(
+            roi,
+            (max(1, width // block), max(1, height // block)),
+            interpolation=cv2.INTER_AREA)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_NEAREST)
+
+
+def blur_boxes(img, boxes, kernel_size):
+    """矩形領域をぼかす。小さな矩形でも kernel_size より弱くはしない
+
+    縮小してからぼかすので、大きなカーネルでもコストはほとんど増えない
+    """
+    _apply_regions(img, boxes, partial(_fast_blur, kernel_size=int(kernel_size) | 1))
+    return img
+
+
+def mosaic_boxes(img, boxes, scale):
+    """矩形領域をモザイクにする。scale はモザイク 1 マスの大きさ (px)"""
+    buckets = _size_buckets(boxes)
+    for bucket in np.unique(buckets):
+        block = int(max(1, min(scale, bucket)))
+        _apply_regions(
+                img,
+                boxes[buckets == bucket],
+                partial(_pixelate, block=block))
+    return img
+
+
+class Overlay():
+    """アルファ付き画像を矩形領域に合成する
+
+    画像はプリマルチプライド済みの uint8 で保持し、リサイズ結果は
+    (w, h) をキーに LRU でキャッシュする
+    """
+
+    def __init__(self, image, cache_size=128):
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        if image.shape[2] == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+        alpha = image[:, :, 3:4].astype(np.uint16)
+        premultiplied = (image[:, :, :3] * alpha + 127) // 255
+        self._image = np.dstack(
+                [premultiplied.astype(np.uint8), image[:, :, 3]])
+        self._resized = lru_cache(maxsize=cache_size)(self._resize)
+
+    def _resize(self, width, height):
+        # プリマルチプライド済みなので補間しても縁に色が滲まない
+        resized = cv2.resize(self._image, (width, height))
+        bgr = np.ascontiguousarray(resized[:, :, :3])
+        inv_alpha = cv2.merge([255 - resized[:, :, 3]] * 3)
+        return bgr, inv_alpha
+
+    def composite(self, img, x1, y1, x2, y2):
+        width = x2 - x1
+        height = y2 - y1
+        if width <= 0 or height <= 0:
+            return img
+        cx1, cy1, cx2, cy2 = clip_box(
+                x1, y1, x2, y2, img.shape[1], img.shape[0])
+        if cx1 >= cx2 or cy1 >= cy2:
+            return img
+
+        bgr, inv_alpha = self._resized(width, height)
+        src = (slice(cy1 - y1, cy2 - y1), slice(cx1 - x1, cx2 - x1))
+        roi = img[cy1:cy2, cx1:cx2]
+        # dst = overlay + dst * (1 - alpha)
+        cv2.multiply(roi, inv_alpha[src], dst=roi, scale=1. / 255.)
+        cv2.add(roi, bgr[src], dst=roi)
+        return img
+
+    def draw(self, img, boxes):
+        # 小さい矩形から順に描く
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        for x1, y1, x2, y2 in boxes[np.argsort(areas, kind="stable")]:
+            self.composite(img, x1, y1, x2, y2)
+        return img
+
+
+@lru_cache(maxsize=8)
+def load_overlay(image_path):
     # アルファ値込みで使いたい
-    overlay_img = cv2.imread(pargs["draw_image"], cv2.IMREAD_UNCHANGED)
+    return Overlay(cv2.imread(image_path, cv2.IMREAD_UNCHANGED))
 
-    widths = result["x2"] - result["x1"]
-    heights = result["y2"] - result["y1"]
-    rs = result.copy()
-    rs["largeness"] = widths * heights
-    rs = rs.sort_values(by="largeness", ascending=True)
 
-    for r in rs.itertuples():
-        if r.cls not in targets:
-            continue
-        # 描画領域の左上と右下座標
-        rect_width = round(r.x2) - round(r.x1)
-        rect_height = round(r.y2) - round(r.y1)
+_FUNCTION_BY_STYLE = dict()
 
-        resized_overlay = cv2.resize(
-                overlay_img,
-                (rect_width, rect_height))
 
-        overlay_bgr = resized_overlay[:, :, :3]  # BGRチャンネル
-        overlay_alpha = resized_overlay[:, :, 3]  # アルファチャンネル
-        # アルファ値を0-1に正規化
-        overlay_alpha = overlay_alpha / 255.0
+def register(style):
+    """描画スタイルを登録する。関数は (img, result, targets, pargs) を受け取る"""
+    def decorator(function):
+        _FUNCTION_BY_STYLE[style] = function
+        return function
+    return decorator
 
-        # 矩形範囲内の背景画像部分を取り出す
-        background_region = img[round(r.y1):round(r.y2), round(r.x1):round(r.x2)]
 
-        # アルファチャンネルを使って背景とオーバーレイ画像をブレンド
-        for c in range(0, 3):  # 各カラー（BGR）チャンネルで合成
-            background_region[:, :, c] = overlay_alpha * overlay_bgr[:, :, c] + (1 - overlay_alpha) * background_region[:, :, c]
+def styles():
+    return sorted(_FUNCTION_BY_STYLE)
 
-            # 合成結果を元の背景画像に適用
-            img[round(r.y1):round(r.y2), round(r.x1):round(r.x2)] = background_region
 
+@register("rect")
+def draw_rect(img, result, targets, pargs):
+    color = tuple(pargs.get("color", (255, 0, 0)))
+    thickness = pargs.get("thickness", 2)
+    for x1, y1, x2, y2 in target_boxes(result, targets).tolist():
+        cv2.rectangle(img, (x1, y1), (x2, y2), color, thickness)
     return img
 
 
+@register("image")
+def draw_image(img, result, targets, pargs):
+    overlay = load_overlay(pargs["draw_image"])
+    return overlay.draw(img, target_boxes(result, targets))
+
+
+@register("blur")
+def draw_blur(img, result, targets, pargs):
+    return blur_boxes(
+            img, target_boxes(result, targets), pargs.get("kernel_size", 51))
+
+
+@register("mosaic")
+def draw_mosaic(img, result, targets, pargs):
+    return mosaic_boxes(
+            img, target_boxes(result, targets), pargs.get("scale", 50))
+
+
 def call(style, img, result, targets, pargs):
-    function_by_style = {
-            "rect": draw_rect,
-            "image": draw_image,
-            }
-    return function_by_style[style](img, result, targets, pargs)
+    return _FUNCTION_BY_STYLE[style](img, result, targets, pargs)
@@ -1,70 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+import os
+import tempfile
+
 import click
 import ffmpeg
 from moviepy.editor import VideoFileClip, concatenate_videoclips
-from pydub import AudioSegment, silence
-import os
+import numpy as np
 import tqdm
 
+from . import media
+
 
 @click.group()
 def edit():
     pass
 
 
-def _extract_audio_track(
+def _get_silence_intervals(
         input_video_path,
         audio_track_num,
-        output_audio_path):
-    # 指定した音声トラックを抽出（ここで無音判定を行うトラック）
-    (
+        min_silence_len=1000,
+        silence_thresh=-40,
+        block_seconds=10):
+    # 指定した音声トラックを PCM のまま ffmpeg から読み込みつつ無音判定を行う
+    probe = ffmpeg.probe(input_video_path, select_streams=f"a:{audio_track_num}")
+    stream = probe["streams"][0]
+    rate = int(stream["sample_rate"])
+    channels = int(stream["channels"])
+    process = (
         ffmpeg
         .input(input_video_path)
         .output(
-            output_audio_path,
-            map=f'0:a:{audio_track_num}',
-            acodec='pcm_s16le')
-        .run()
+            "pipe:",
+            map=f"0:a:{audio_track_num}",
+            format="s16le",
+            acodec="pcm_s16le")
+        .global_args("-loglevel", "error")
+        .run_async(pipe_stdout=True)
     )
+    detector = media.SilenceDetector(rate, channels, min_silence_len, silence_thresh)
+    block_bytes = rate * block_seconds * channels * 2
+    while True:
+        pcm = process.stdout.read(block_bytes)
+        if not pcm:
+            break
+        detector.feed(pcm)
+    process.wait()
+    return media.non_silent_ranges(detector, rate, min_silence_len)
 
 
-def _get_silence_intervals(
-        audio_path,
-        min_silence_len=1000,
-        silence_thresh=-40):
-    # pydubで音声を読み込み、無音区間を取得
-    sound = AudioSegment.from_wav(audio_path)
-    silent_ranges = silence.detect_silence(
-            sound,
-            min_silence_len=min_silence_len,
-            silence_thresh=silence_thresh)
-
-    # 無音でない区間を取得（ミリ秒から秒に変換）
-    non_silent_ranges = []
-    if silent_ranges:
-        non_silent_ranges = [
-                (silent_ranges[i-1][1] / 1000, silent_ranges[i][0] / 1000)
-                for i in range(1, len(silent_ranges))]
-        # 最初と最後の音声区間を追加
-        if silent_ranges[0][0] > 0:
-            non_silent_ranges.insert(0, (0, silent_ranges[0][0] / 1000))
-        if silent_ranges[-1][1] < sound.duration_seconds * 1000:
-            non_silent_ranges.append(
-                    (silent_ranges[-1][1] / 1000, sound.duration_seconds))
-    else:
-        non_silent_ranges = [(0, sound.duration_seconds)]  # 無音区間がない場合
-
-    return non_silent_ranges
-
-
-def _trim_video_with_all_tracks(input_video_path, output_video_path, non_silent_ranges):
-    # 入力ファイルを取得
-    input_stream = ffmpeg.input(input_video_path)
-    
+def _trim_video_with_all_tracks(
+        input_video_path,
+        output_video_path,
+        non_silent_ranges,
+        audio_track_count,
+        vcodec="libx264",
+        acodec="aac"):
+    # 区間の範囲だけを入力シークでデコードする
+    offset = non_silent_ranges[0][0]
+    duration = non_silent_ranges[-1][1] - offset
+    input_stream = ffmpeg.input(input_video_path, ss=offset, t=duration)
+
     # トリミングされたクリップを保持するリスト
     video_clips = []
-    audio_clips = [[] for _ in range(len(ffmpeg.probe(input_video_path)['streams']) - 1)]  # 各オーディオトラックごとにリストを保持
-    
+    audio_clips = [[] for _ in range(audio_track_count)]  # 各オーディオトラックごとにリストを保持
+
     for start, end in non_silent_ranges:
+        start -= offset
+        end -= offset
         # 映像トラックをトリミング
         video_trimmed = input_stream.trim(start=start, end=end).setpts('PTS-STARTPTS')
         video_clips.append(video_trimmed)
@@ -89,9 +93,110 @@ def _trim_video_with_all_tracks(input_video_path, output_video_path, non_silent_
                 audio_concat[1]
                 for audio_concat in audio_concats],
             output_video_path,
-            vcodec='h264_videotoolbox')
-    ffmpeg.run(output)
+            vcodec=vcodec,
+            acodec=acodec)
+    ffmpeg.run(output.overwrite_output().global_args("-loglevel", "error"))
+    return output_video_path
+
+
+def _copy_range(input_video_path, start, end, fps, output_video_path):
+    # キーフレームに揃えた区間は再エンコードせずに切り出す
+    # (丸め誤差で 1 つ前のキーフレームに戻らないよう半フレーム後ろを指定する)
+    seek = start + 0.5 / fps
+    input_stream = ffmpeg.input(input_video_path, ss=seek, t=end - seek)
+    (
+        ffmpeg
+        .output(
+            input_stream["v:0"],
+            input_stream["a?"],
+            output_video_path,
+            c="copy",
+            avoid_negative_ts="make_zero")
+        .overwrite_output()
+        .global_args("-loglevel", "error")
+        .run()
+    )
+    return output_video_path
+
+
+def _snap_to_keyframes(non_silent_ranges, keyframes, duration):
+    # 開始は直前、終了は直後のキーフレームに広げ、重なった区間はまとめる
+    bounds = np.append(keyframes, duration)
+    snapped = []
+    for start, end in non_silent_ranges:
+        start = bounds[max(np.searchsorted(bounds, start, side="right") - 1, 0)]
+        end = bounds[min(np.searchsorted(bounds, end, side="left"), len(bounds) - 1)]
+        if snapped and start <= snapped[-1][1]:
+            snapped[-1] = (snapped[-1][0], max(snapped[-1][1], end))
+        else:
+            snapped.append((start, end))
+    return snapped
+
+
+def _concat(segment_paths, output_video_path, tmp_dir):
+    list_path = os.path.join(tmp_dir, "segments.txt")
+    with open(list_path, "w") as f:
+        for path in segment_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+    (
+        ffmpeg
+        .input(list_path, format="concat", safe=0)
+        .output(output_video_path, map="0", c="copy")
+        .overwrite_output()
+        .global_args("-loglevel", "error")
+        .run()
+    )
+
+
+def _cut_and_concat(
+        input_video_path,
+        output_video_path,
+        non_silent_ranges,
+        vcodec,
+        acodec,
+        jobs,
+        batch_size,
+        snap_keyframes):
+    """区間を並列に切り出して concat demuxer で連結する
 
+    通常は batch_size 個ずつの区間を 1 つの ffmpeg で再エンコードする。
+    snap_keyframes の場合は区間をキーフレームに広げてストリームコピーする
+    """
+    probe = ffmpeg.probe(input_video_path)
+    audio_track_count = sum(
+            1 for stream in probe["streams"] if stream["codec_type"] == "audio")
+    duration = float(probe["format"]["duration"])
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        # 各タスクは ffmpeg の子プロセスを起動して待つだけなのでスレッドで並べる
+        futures = []
+        if snap_keyframes:
+            video_stream = next(
+                    stream for stream in probe["streams"] if stream["codec_type"] == "video")
+            rates = [video_stream.get(k, "0/0") for k in ("avg_frame_rate", "r_frame_rate")]
+            fps = next((float(Fraction(r)) for r in rates if not r.startswith("0/")), 30.)
+            ranges = _snap_to_keyframes(
+                    non_silent_ranges,
+                    media.probe_keyframe_times(input_video_path),
+                    duration)
+            print(f"{len(non_silent_ranges)} ranges snapped to {len(ranges)} keyframe ranges")
+            for i, (start, end) in enumerate(ranges):
+                futures.append(executor.submit(
+                    _copy_range, input_video_path, start, end, fps,
+                    os.path.join(tmp_dir, f"{i:06d}.mkv")))
+        else:
+            for i in range(0, len(non_silent_ranges), batch_size):
+                futures.append(executor.submit(
+                    _trim_video_with_all_tracks,
+                    input_video_path,
+                    os.path.join(tmp_dir, f"{i:06d}.mkv"),
+                    non_silent_ranges[i:i + batch_size],
+                    audio_track_count,
+                    vcodec,
+                    acodec))
+        segment_paths = [f.result() for f in tqdm.tqdm(futures)]
+        _concat(segment_paths, output_video_path, tmp_dir)
 
 
 @edit.command()
@@ -100,27 +205,48 @@ def _trim_video_with_all_tracks(input_video_path, output_video_path, non_silent_
 @click.option("--audio-track-num", type=int, default=1)
 @click.option("--min-silence-len", type=int, default=1000)
 @click.option("--silence-thresh", type=int, default=-40)
+@click.option("--padding", type=int, default=0, help="ms added before and after each range")
+@click.option("--merge-gap", type=int, default=0, help="merge ranges closer than this (ms)")
+@click.option("--min-segment-len", type=int, default=0, help="drop ranges shorter than this (ms)")
+@click.option("--vcodec", type=str, default="libx264", help="e.g. h264_videotoolbox on macOS")
+@click.option("--acodec", type=str, default="aac")
+@click.option("--jobs", type=int, default=os.cpu_count(), help="number of parallel ffmpeg processes")
+@click.option("--batch-size", type=int, default=50, help="ranges per ffmpeg filter graph")
+@click.option(
+    "--snap-keyframes", is_flag=True, default=False,
+    help="widen ranges to keyframes and stream-copy them instead of re-encoding")
 def filter_silence(
         input_video_path,
         output_video_path,
         audio_track_num=0,
         min_silence_len=1000,
-        silence_thresh=-40):
-    # 一時的に保存する音声ファイルのパス
-    audio_path = f"/tmp/temp_audio_track_{audio_track_num}.wav"
-
-    # 指定されたトラックの音声を抽出
-    _extract_audio_track(input_video_path, audio_track_num, audio_path)
-
+        silence_thresh=-40,
+        padding=0,
+        merge_gap=0,
+        min_segment_len=0,
+        vcodec="libx264",
+        acodec="aac",
+        jobs=1,
+        batch_size=50,
+        snap_keyframes=False):
     # 無音判定に基づいて無音でない区間を取得
-    non_silent_ranges = _get_silence_intervals(audio_path, min_silence_len, silence_thresh)
-    print(non_silent_ranges)
+    non_silent_ranges = _get_silence_intervals(
+            input_video_path, audio_track_num, min_silence_len, silence_thresh)
+    print(f"{len(non_silent_ranges)} non silent ranges")
+    non_silent_ranges = media.postprocess_intervals(
+            non_silent_ranges, padding, merge_gap, min_segment_len)
+    print(f"{len(non_silent_ranges)} ranges after padding and merging")
 
     # 無音でない区間で、全てのトラックをトリミング
-    _trim_video_with_all_tracks(input_video_path, output_video_path, non_silent_ranges)
-
-    # 一時ファイルの削除
-    os.remove(audio_path)
+    _cut_and_concat(
+            input_video_path,
+            output_video_path,
+            non_silent_ranges,
+            vcodec,
+            acodec,
+            jobs,
+            batch_size,
+            snap_keyframes)
 
 
 def _get_video_resolution(video_path):
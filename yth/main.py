@@ -6,6 +6,7 @@ from .blind import blind
 from .whisper import whisper
 from .edit import edit
 from .servers import servers
+from .batch import batch
 
 
 @click.group()
@@ -21,6 +22,7 @@ def entry_point():
             whisper,
             edit,
             servers,
+            batch,
             ]
     [
         blindpy.add_command(c)
@@ -0,0 +1,173 @@
+"""ffprobe と音声の無音判定など、複数のコマンドで使う処理"""
+import ffmpeg
+import numpy as np
+
+
+def probe_keyframe_times(video_path):
+    """映像ストリームのキーフレームの時刻 (秒) を昇順で返す
+
+    時刻はストリームの start_time を引いた、ファイル先頭からの相対値にする
+    (-ss や無音区間の時刻と同じ基準。.ts などは start_time が 0 でない)
+    """
+    probe = ffmpeg.probe(
+            video_path,
+            select_streams="v:0",
+            show_entries="packet=pts_time,flags:stream=start_time")
+    start_time = float(probe["streams"][0].get("start_time", 0.))
+    return np.unique([
+        float(packet["pts_time"]) - start_time
+        for packet in probe.get("packets", [])
+        if "K" in packet.get("flags", "") and "pts_time" in packet])
+
+
+def probe_keyframes(video_path, fps):
+    """映像ストリームのキーフレームのフレーム番号を昇順で返す"""
+    keyframes = {round(t * fps) for t in probe_keyframe_times(video_path)}
+    return sorted(keyframes | {0})
+
+
+class SilenceDetector():
+    """PCM を少しずつ受け取って無音区間 (ミリ秒) を求める
+
+    pydub の silence.detect_silence (seek_step=1) と同じ判定を、1 ミリ秒ごとの
+    二乗和の累積を使って窓ごとにまとめて計算する
+    """
+
+    def __init__(self, rate, channels, min_silence_len, silence_thresh):
+        self._rate = rate
+        self._channels = channels
+        self._len = min_silence_len
+        # dBFS = 20 * log10(rms / 32768) (rms は整数に切り捨て)
+        self._thresh = 32768 * 10 ** (silence_thresh / 20)
+        self.frames = 0
+
+        # 1 ミリ秒に満たない端数フレームの二乗和
+        self._pending = np.zeros(0, dtype=np.int64)
+        self._next_ms = 0
+        # まだ窓の先頭として判定していない 1 ミリ秒ごとの二乗和とサンプル数
+        self._energies = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._first_ms = 0
+
+        self.silent_ranges = list()
+        self._range_start = None
+        self._prev = None
+
+    def _frame_at(self, ms):
+        return ms * self._rate // 1000
+
+    def feed(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.int64)
+        squares = (samples ** 2).reshape(-1, self._channels).sum(axis=1)
+        self.frames += len(squares)
+        self._pending = np.concatenate([self._pending, squares])
+        self._bucket(final=False)
+        self._scan()
+
+    def finish(self):
+        self._bucket(final=True)
+        self._scan()
+        if self._prev is not None:
+            self.silent_ranges.append(
+                    [int(self._range_start), int(self._prev) + self._len])
+        return self.silent_ranges
+
+    def _bucket(self, final):
+        start_frame = self._frame_at(self._next_ms)
+        end_frame = start_frame + len(self._pending)
+        last_ms = end_frame * 1000 // self._rate
+        while self._frame_at(last_ms + 1) <= end_frame:
+            last_ms += 1
+        ms = np.arange(self._next_ms, last_ms + 1, dtype=np.int64)
+        bounds = self._frame_at(ms) - start_frame
+        if final and bounds[-1] < len(self._pending):
+            bounds = np.append(bounds, len(self._pending))
+        if len(bounds) < 2:
+            return
+
+        energies = np.add.reduceat(self._pending[:bounds[-1]], bounds[:-1])
+        self._energies = np.concatenate([self._energies, energies])
+        self._counts = np.concatenate(
+                [self._counts, np.diff(bounds) * self._channels])
+        self._pending = self._pending[bounds[-1]:]
+        self._next_ms += len(bounds) - 1
+
+    def _scan(self):
+        windows = len(self._energies) - self._len + 1
+        if windows <= 0:
+            return
+        # 整数のまま累積して丸め誤差で判定が揺れないようにする
+        energies = np.r_[0, np.cumsum(self._energies)]
+        counts = np.r_[0, np.cumsum(self._counts)]
+        sums = energies[self._len:] - energies[:windows]
+        sizes = counts[self._len:] - counts[:windows]
+        rms = np.floor(np.sqrt(sums / np.maximum(sizes, 1)))
+        self._merge(np.flatnonzero(rms < self._thresh) + self._first_ms)
+
+        self._energies = self._energies[windows:]
+        self._counts = self._counts[windows:]
+        self._first_ms += windows
+
+    def _merge(self, starts):
+        # 窓の先頭が min_silence_len より離れたら別の無音区間にする
+        if len(starts) == 0:
+            return
+        if self._prev is None:
+            self._range_start = starts[0]
+            self._prev = starts[0]
+        starts = np.r_[self._prev, starts]
+        for b in np.flatnonzero(np.diff(starts) > self._len):
+            self.silent_ranges.append(
+                    [int(self._range_start), int(starts[b]) + self._len])
+            self._range_start = starts[b + 1]
+        self._prev = starts[-1]
+
+
+def non_silent_ranges(detector, rate, min_silence_len):
+    """入力を最後まで与えた SilenceDetector から無音でない区間 (秒) を求める"""
+    silent_ranges = detector.finish()
+    duration_seconds = detector.frames / rate
+    if duration_seconds * 1000 < min_silence_len:
+        silent_ranges = []
+
+    # 無音でない区間を取得（ミリ秒から秒に変換）
+    non_silent_ranges = []
+    if silent_ranges:
+        non_silent_ranges = [
+                (silent_ranges[i-1][1] / 1000, silent_ranges[i][0] / 1000)
+                for i in range(1, len(silent_ranges))]
+        # 最初と最後の音声区間を追加
+        if silent_ranges[0][0] > 0:
+            non_silent_ranges.insert(0, (0, silent_ranges[0][0] / 1000))
+        if silent_ranges[-1][1] < duration_seconds * 1000:
+            non_silent_ranges.append(
+                    (silent_ranges[-1][1] / 1000, duration_seconds))
+    else:
+        non_silent_ranges = [(0, duration_seconds)]  # 無音区間がない場合
+
+    return non_silent_ranges
+
+
+def postprocess_intervals(
+        non_silent_ranges,
+        padding=0,
+        merge_gap=0,
+        min_segment_len=0):
+    """発話区間の前後に余白を付け、近い区間をまとめ、短すぎる区間を落とす
+
+    padding, merge_gap, min_segment_len はミリ秒
+    """
+    if not non_silent_ranges:
+        return non_silent_ranges
+    ranges = np.asarray(non_silent_ranges, dtype=np.float64)
+    starts = np.maximum(ranges[:, 0] - padding / 1000, 0.)
+    ends = ranges[:, 1] + padding / 1000
+
+    # 前の区間の終わりとの間隔が merge_gap 以下ならまとめる
+    gaps = starts[1:] - np.maximum.accumulate(ends)[:-1]
+    groups = np.r_[0, np.cumsum(gaps > merge_gap / 1000)]
+    starts = np.minimum.reduceat(starts, np.r_[0, np.flatnonzero(np.diff(groups)) + 1])
+    ends = np.maximum.reduceat(ends, np.r_[0, np.flatnonzero(np.diff(groups)) + 1])
+
+    keep = ends - starts >= min_segment_len / 1000
+    return list(zip(starts[keep].tolist(), ends[keep].tolist()))
@@ -0,0 +1,216 @@
+"""検出結果ファイルの読み書き
+
+既定は numpy の構造化配列 (.npy) で、そのままメモリマップして読める。
+拡張子が .csv / .txt の場合は従来通り CSV で書き出す。
+読み込み時は中身から形式を判定する。
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+DTYPE = np.dtype([
+    ("frame_id", "<i4"),
+    ("tracking_id", "<i4"),
+    ("cls", "u1"),
+    ("conf", "<f4"),
+    ("x1", "<f4"),
+    ("y1", "<f4"),
+    ("x2", "<f4"),
+    ("y2", "<f4"),
+    ])
+COLUMN_NAMES = list(DTYPE.names)
+
+_CSV_SUFFIXES = (".csv", ".txt")
+_MAGIC = b"\x93NUMPY"
+# 件数を書き換えてもヘッダ長が変わらないように余裕をもって確保する
+_HEADER_SIZE = 256
+
+
+def is_binary_path(path):
+    """書き出し先のパスがバイナリ形式になるかどうか"""
+    return not path.lower().endswith(_CSV_SUFFIXES)
+
+
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(_MAGIC)) == _MAGIC
+
+
+def _npy_header(length):
+    header = repr({
+        "descr": np.lib.format.dtype_to_descr(DTYPE),
+        "fortran_order": False,
+        "shape": (length,),
+        })
+    prefix = _MAGIC + b"\x01\x00"
+    size = _HEADER_SIZE - len(prefix) - 2
+    header = header.ljust(size - 1) + "\n"
+    assert len(header) == size, "header overflow"
+    return prefix + size.to_bytes(2, "little") + header.encode("latin1")
+
+
+def _parse_id(values):
+    # 旧形式では tracking_id が None や tensor([3.]) の文字列で入っている
+    numeric = pd.to_numeric(values, errors="coerce")
+    if numeric.isna().any():
+        extracted = values.astype(str).str.extract(
+                r"(-?\d+(?:\.\d*)?)", expand=False)
+        numeric = numeric.fillna(pd.to_numeric(extracted, errors="coerce"))
+    return numeric.fillna(-1)
+
+
+def meta_path(path):
+    # 検出時の解像度などの付随情報は隣の JSON に置く
+    return f"{path}.meta.json"
+
+
+def read_meta(path):
+    if not os.path.exists(meta_path(path)):
+        return dict()
+    with open(meta_path(path)) as f:
+        return json.load(f)
+
+
+def write_meta(path, meta):
+    if not meta:
+        if os.path.exists(meta_path(path)):
+            os.remove(meta_path(path))
+        return
+    with open(meta_path(path), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+def to_records(df):
+    """DataFrame を DTYPE の構造化配列に変換する"""
+    records = np.empty(len(df), dtype=DTYPE)
+    for name in COLUMN_NAMES:
+        values = df[name]
+        if name == "tracking_id":
+            values = _parse_id(values)
+        records[name] = values
+    return records
+
+
+def _read_csv(path, **kwargs):
+    return pd.read_csv(path, header=0, **kwargs)
+
+
+def load(path):
+    """構造化配列として読み込む。バイナリ形式の場合はメモリマップする"""
+    if is_binary(path):
+        return np.load(path, mmap_mode="r")
+    return to_records(_read_csv(path))
+
+
+def read(path):
+    return pd.DataFrame(load(path))
+
+
+def iter_chunks(path, chunk_rows=1000000):
+    """ファイル全体を読み込まずに chunk_rows 行ずつ構造化配列で返す"""
+    if is_binary(path):
+        records = np.load(path, mmap_mode="r")
+        for begin in range(0, len(records), chunk_rows):
+            yield np.array(records[begin:begin + chunk_rows])
+        return
+    for df in _read_csv(path, chunksize=chunk_rows):
+        yield to_records(df)
+
+
+def is_sorted(path, chunk_rows=1000000):
+    """frame_id の昇順に並んでいるかを、全体を読み込まずに確かめる"""
+    prev = None
+    for records in iter_chunks(path, chunk_rows):
+        frame_ids = records["frame_id"]
+        if len(frame_ids) == 0:
+            continue
+        if (prev is not None and frame_ids[0] < prev) or np.any(np.diff(frame_ids) < 0):
+            return False
+        prev = frame_ids[-1]
+    return True
+
+
+def read_range(path, start_frame, end_frame=None):
+    """frame_id 順に並んだバイナリ形式から [start_frame, end_frame) の行だけを読む
+
+    メモリマップ上で二分探索するので、ファイル全体は読み込まない
+    """
+    records = np.load(path, mmap_mode="r")
+    frame_ids = records["frame_id"]
+    begin = np.searchsorted(frame_ids, start_frame)
+    end = len(records) if end_frame is None else np.searchsorted(frame_ids, end_frame)
+    return pd.DataFrame(np.array(records[begin:end]))
+
+
+class Writer():
+    """検出結果を追記していき、close で確定させる"""
+
+    def __init__(self, path, chunk_rows=100000, meta=None):
+        self._path = path
+        write_meta(path, meta)
+        self._binary = is_binary_path(path)
+        self._chunk_rows = chunk_rows
+        self._chunks = list()
+        self._buffered = 0
+        self._length = 0
+        if self._binary:
+            self._file = open(path, "wb")
+            self._file.write(_npy_header(0))
+        else:
+            self._file = open(path, "w", newline="")
+            pd.DataFrame(columns=COLUMN_NAMES).to_csv(self._file, index=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, records):
+        if len(records) == 0:
+            return
+        self._chunks.append(np.asarray(records, dtype=DTYPE))
+        self._buffered += len(records)
+        if self._buffered >= self._chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._chunks:
+            return
+        records = np.concatenate(self._chunks)
+        if self._binary:
+            self._file.write(records.tobytes())
+        else:
+            pd.DataFrame(records).to_csv(self._file, header=False, index=False)
+        self._length += len(records)
+        self._chunks = list()
+        self._buffered = 0
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        if self._binary:
+            self._file.seek(0)
+            self._file.write(_npy_header(self._length))
+        self._file.close()
+
+
+def write(path, records, meta=None):
+    if isinstance(records, pd.DataFrame):
+        records = to_records(records)
+    with Writer(path, meta=meta) as writer:
+        writer.append(records)
+
+
+def copy(src, dst):
+    """付随情報ごとコピーする。形式が違う場合は変換する"""
+    if is_binary(src) == is_binary_path(dst):
+        shutil.copyfile(src, dst)
+        write_meta(dst, read_meta(src))
+    else:
+        write(dst, load(src), read_meta(src))
@@ -1,4 +1,134 @@
+import json
+
 import click
+import numpy as np
+
+from . import result_io
+from .cache import DetectionCache
+from .tracking import boxes_of
+
+
+_COORDS = ["x1", "y1", "x2", "y2"]
+
+
+def _group_bounds(keys):
+    """ソート済みの keys について、各行が属するグループの [start, end) を返す"""
+    n = len(keys)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    ends = np.r_[starts[1:], n]
+    sizes = ends - starts
+    return np.repeat(starts, sizes), np.repeat(ends, sizes)
+
+
+def _pairwise_iou(a, b):
+    x1 = np.maximum(a[:, 0], b[:, 0])
+    y1 = np.maximum(a[:, 1], b[:, 1])
+    x2 = np.minimum(a[:, 2], b[:, 2])
+    y2 = np.minimum(a[:, 3], b[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a + area_b - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def _nms(records, iou_threshold):
+    # 同じフレーム・クラス内で、信頼度が高い矩形と重なる矩形を落とす
+    # IoU は全ペアまとめて計算し、重なるペアだけを信頼度順にたどる貪欲法で判定する
+    order = np.lexsort((-records["conf"], records["cls"], records["frame_id"]))
+    records = records[order]
+    keys = records["frame_id"].astype(np.int64) * 256 + records["cls"]
+    _, ends = _group_bounds(keys)
+
+    n = len(records)
+    counts = ends - np.arange(n) - 1
+    i = np.repeat(np.arange(n), counts)
+    j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    boxes = boxes_of(records).astype(np.float64)
+    iou = _pairwise_iou(boxes[i], boxes[j])
+    overlap = iou > iou_threshold
+    suppressed = np.zeros(n, dtype=bool)
+    # ペアは i (信頼度の高い側) の順に並んでいるので、i を見る時点で
+    # i 自身が抑制されたかは確定している。抑制された矩形は他を抑制しない
+    for a, b in zip(i[overlap].tolist(), j[overlap].tolist()):
+        if not suppressed[a]:
+            suppressed[b] = True
+    return records[~suppressed]
+
+
+def _drop_short_tracks(records, min_track_len):
+    ids = records["tracking_id"]
+    _, inverse, counts = np.unique(ids, return_inverse=True, return_counts=True)
+    return records[(ids < 0) | (counts[inverse] >= min_track_len)]
+
+
+def _fill_gaps(tracked, max_gap):
+    # 同じ ID で max_gap フレーム以下の欠けを線形補間で埋める
+    frames = tracked["frame_id"]
+    gap = frames[1:] - frames[:-1]
+    fill = (tracked["tracking_id"][1:] == tracked["tracking_id"][:-1]) \
+        & (gap > 1) & (gap <= max_gap + 1)
+    starts = np.flatnonzero(fill)
+    if len(starts) == 0:
+        return tracked
+
+    inserts = gap[starts] - 1
+    src = np.repeat(starts, inserts)
+    step = np.arange(len(src)) - np.repeat(np.cumsum(inserts) - inserts, inserts) + 1
+    t = step / np.repeat(gap[starts], inserts)
+
+    filled = tracked[src].copy()
+    filled["frame_id"] += step
+    for name in ["conf"] + _COORDS:
+        v0 = tracked[name][src]
+        v1 = tracked[name][src + 1]
+        filled[name] = v0 + t * (v1 - v0)
+
+    merged = np.concatenate([tracked, filled])
+    order = np.lexsort((merged["frame_id"], merged["tracking_id"]))
+    return merged[order]
+
+
+def _smooth(tracked, window):
+    # 同じ ID の中で前後 window // 2 行の移動平均をとる
+    starts, ends = _group_bounds(tracked["tracking_id"])
+    half = window // 2
+    index = np.arange(len(tracked))
+    lo = np.maximum(index - half, starts)
+    hi = np.minimum(index + half + 1, ends)
+    for name in _COORDS:
+        cumsum = np.r_[0., np.cumsum(tracked[name], dtype=np.float64)]
+        tracked[name] = (cumsum[hi] - cumsum[lo]) / (hi - lo)
+    return tracked
+
+
+def clean_records(
+        records,
+        min_conf=0.25,
+        nms_iou=0.5,
+        min_track_len=5,
+        max_gap=5,
+        smooth_window=5):
+    """信頼度・NMS・短い追跡の除去、欠けの補間、平滑化をまとめて行う"""
+    records = records[records["conf"] >= min_conf]
+    if nms_iou < 1.:
+        records = _nms(records, nms_iou)
+    if min_track_len > 1:
+        records = _drop_short_tracks(records, min_track_len)
+
+    # 追跡 ID のある行だけ ID, フレーム順に並べて時間方向の処理をする
+    is_tracked = records["tracking_id"] >= 0
+    tracked = records[is_tracked]
+    tracked = tracked[np.lexsort((tracked["frame_id"], tracked["tracking_id"]))]
+    if max_gap > 0:
+        tracked = _fill_gaps(tracked, max_gap)
+    if smooth_window > 1:
+        tracked = _smooth(tracked, smooth_window)
+
+    records = np.concatenate([records[~is_tracked], tracked])
+    records = records[np.argsort(records["frame_id"], kind="stable")]
+    return records
 
 
 @click.group()
@@ -6,14 +136,161 @@ def results():
     pass
 
 
+def _add_counts(total, values):
+    counts = np.bincount(values)
+    if len(counts) > len(total):
+        total = np.pad(total, (0, len(counts) - len(total)))
+    total[:len(counts)] += counts
+    return total
+
+
+def _quantiles(histogram, edges, qs):
+    if histogram.sum() == 0:
+        return dict()
+    cumulative = np.cumsum(histogram) / histogram.sum()
+    return {
+        str(q): float(edges[min(np.searchsorted(cumulative, q) + 1, len(edges) - 1)])
+        for q in qs}
+
+
+def _describe(values, qs):
+    if len(values) == 0:
+        return dict()
+    report = dict(mean=float(values.mean()), max=int(values.max()))
+    report.update({str(q): float(np.quantile(values, q)) for q in qs})
+    return report
+
+
+def _range_label(lo, hi, last):
+    if hi == last:
+        return f"{lo}-"
+    return f"{lo}" if hi - 1 == lo else f"{lo}-{hi - 1}"
+
+
+def _report(input_filepath, chunk_rows, top):
+    # チャンクごとに集計値だけを足し込んでいく
+    rows = 0
+    class_counts = np.zeros(256, dtype=np.int64)
+    frame_counts = np.zeros(0, dtype=np.int64)
+    track_lengths = np.zeros(0, dtype=np.int64)
+    conf_edges = np.linspace(0., 1., 1001)
+    conf_histogram = np.zeros(len(conf_edges) - 1, dtype=np.int64)
+    for records in result_io.iter_chunks(input_filepath, chunk_rows):
+        rows += len(records)
+        class_counts += np.bincount(records["cls"], minlength=256)
+        frame_counts = _add_counts(frame_counts, records["frame_id"])
+        ids = records["tracking_id"]
+        track_lengths = _add_counts(track_lengths, ids[ids >= 0])
+        conf_histogram += np.histogram(
+                np.clip(records["conf"], 0., 1.), bins=conf_edges)[0]
+
+    qs = [0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+    track_lengths = track_lengths[track_lengths > 0]
+    length_edges = [1, 2, 5, 10, 30, 100, 300, np.iinfo(np.int64).max]
+    length_histogram = np.histogram(track_lengths, bins=length_edges)[0]
+    top_frames = np.argsort(-frame_counts, kind="stable")[:top]
+    return dict(
+        rows=rows,
+        frames=len(frame_counts),
+        frames_without_boxes=int((frame_counts == 0).sum()),
+        classes={
+            int(c): int(class_counts[c]) for c in np.flatnonzero(class_counts)},
+        boxes_per_frame=_describe(frame_counts, qs),
+        tracks=len(track_lengths),
+        track_length=_describe(track_lengths, qs),
+        track_length_histogram={
+            _range_label(lo, hi, length_edges[-1]): int(n)
+            for lo, hi, n in zip(length_edges[:-1], length_edges[1:], length_histogram)},
+        conf=_quantiles(conf_histogram, conf_edges, qs),
+        top_frames={int(f): int(frame_counts[f]) for f in top_frames},
+        )
+
+
 @results.command()
-@click.option("--input_filepath", type=str, default="/tmp/blindpy-yolo-results.txt")
-def inspect(input_filepath):
-    pass
+@click.option("--input_filepath", type=str, default="/tmp/blindpy-yolo-results.npy")
+@click.option("--chunk-rows", type=int, default=1000000)
+@click.option("--top", type=int, default=10, help="number of most crowded frames to list")
+@click.option("--json", "as_json", is_flag=True, default=False)
+def inspect(input_filepath, chunk_rows, top, as_json):
+    report = _report(input_filepath, chunk_rows, top)
+    if as_json:
+        print(json.dumps(report))
+        return
+
+    print(f"boxes: {report['rows']}, frames: {report['frames']} "
+          f"({report['frames_without_boxes']} without boxes)")
+    print("boxes per class:")
+    for cls, count in report["classes"].items():
+        print(f"  {cls:3d}: {count}")
+    for name in ["boxes_per_frame", "track_length", "conf"]:
+        print(f"{name}:")
+        for key, value in report[name].items():
+            print(f"  {key:>5}: {value:.3f}")
+    print(f"tracks: {report['tracks']}")
+    for key, count in report["track_length_histogram"].items():
+        print(f"  {key:>8}: {count}")
+    print("most crowded frames:")
+    for frame_id, count in report["top_frames"].items():
+        print(f"  {frame_id:8d}: {count}")
+
+
+@results.command()
+@click.option("--input_filepath", type=str, default="/tmp/blindpy-yolo-results.npy")
+@click.option("--output_filepath", type=str, default="/tmp/blindpy-yolo-results-modified.npy")
+@click.option("--min-conf", type=float, default=0.25, help="drop boxes below this confidence")
+@click.option("--nms-iou", type=float, default=0.5, help="per-class NMS IoU threshold, 1 disables")
+@click.option("--min-track-len", type=int, default=5, help="drop tracks shorter than this (rows)")
+@click.option("--max-gap", type=int, default=5, help="fill gaps of up to this many frames per track")
+@click.option("--smooth-window", type=int, default=5, help="moving average window per track, 1 disables")
+def clean(
+        input_filepath,
+        output_filepath,
+        min_conf,
+        nms_iou,
+        min_track_len,
+        max_gap,
+        smooth_window):
+    records = np.array(result_io.load(input_filepath))
+    print(f"input: {len(records)} boxes")
+    records = clean_records(records, min_conf, nms_iou, min_track_len, max_gap, smooth_window)
+    result_io.write(output_filepath, records, result_io.read_meta(input_filepath))
+    print(f"output: {len(records)} boxes to {output_filepath}")
 
 
 @results.command()
-@click.option("--input_filepath", type=str, default="/tmp/blindpy-yolo-results.txt")
-@click.option("--output_filepath", type=str, default="/tmp/blindpy-yolo-results-modified.txt")
-def clean(input_filepath, output_filepath):
+@click.argument("input_filepath", type=str)
+@click.argument("output_filepath", type=str)
+def export(input_filepath, output_filepath):
+    """Convert a results file, *.csv / *.txt are written as CSV"""
+    result_io.write(
+            output_filepath, result_io.load(input_filepath),
+            result_io.read_meta(input_filepath))
+    print(f"output result to {output_filepath}")
+
+
+@results.group()
+def cache():
     pass
+
+
+@cache.command("list")
+def list_cache():
+    entries = DetectionCache().entries()
+    for e in entries:
+        meta = e["meta"]
+        print(
+            f"{e['name']}  {e['size'] / 1024 ** 2:8.1f} MB  "
+            f"{meta.get('video_path', '?')}  {meta.get('params', {})}")
+    total = sum(e["size"] for e in entries)
+    print(f"{len(entries)} entries, {total / 1024 ** 2:.1f} MB")
+
+
+@cache.command()
+@click.option(
+    "--max-size-mb", type=float, default=None,
+    help="size to keep, defaults to YTH_CACHE_MAX_BYTES (20 GB); 0 clears the cache")
+def prune(max_size_mb):
+    max_bytes = None if max_size_mb is None else int(max_size_mb * 1024 ** 2)
+    removed = DetectionCache().prune(max_bytes)
+    for e in removed:
+        print(f"removed {e['name']}")
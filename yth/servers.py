@@ -1,3 +1,6 @@
+import threading
+import time
+
 from flask import Flask, render_template, Response
 import click
 import cv2
@@ -6,55 +9,156 @@ import numpy as np
 
 
 
+# (MIME type, cv2.imencode の拡張子, 透過の有無)
+CODECS = {
+    "jpeg": ("image/jpeg", ".jpg", False),
+    "webp": ("image/webp", ".webp", True),
+    "png": ("image/png", ".png", True),
+}
+
+
 @click.group()
 @click.option("--host", type=str, default="0.0.0.0")
 @click.option("--port", type=int, default=50280)
+@click.option(
+    "--codec", type=click.Choice(list(CODECS)), default="png",
+    help="png / webp keep the transparent background, "
+         "jpeg is faster but has no alpha and uses a chroma green background")
+@click.option("--quality", type=int, default=80, help="jpeg / webp quality (1-100)")
+@click.option("--max-fps", type=float, default=0., help="cap processed frames per second, 0 disables")
 @click.pass_context
-def servers(ctx, host, port):
+def servers(ctx, host, port, codec, quality, max_fps):
     ctx.obj = dict()
     ctx.obj["host"] = host
     ctx.obj["port"] = port
-
-
-
-def _fugashy(camera_id):
-    cap = cv2.VideoCapture(camera_id)
-    kernel = np.ones((3, 3), np.uint8)
-
-
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            continue
-
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frame = cv2.GaussianBlur(frame, (5, 5), 0)
-        frame = cv2.Canny(frame, threshold1=50, threshold2=150)
-
-        core = cv2.dilate(frame, kernel, iterations=4)
-        out = cv2.dilate(core, kernel, iterations=4)
-
-        outline = cv2.subtract(out, core)
-
-        h, w = out.shape
-        rgba = np.zeros((h, w, 4), dtype=np.uint8)
-
-        rgba[out > 0] = (0, 0, 0, 255)
-        rgba[core > 0] = (255, 255, 255, 255)
-
-#       alpha = np.zeros_like(frame)
-#       alpha[frame > 0] = 255
-
-#       frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-#       frame = cv2.merge([frame, alpha])
-
-        _, buffer = cv2.imencode(".png", rgba)
-        frame_bytes = buffer.tobytes()
-        yield (
-            b'--frame\r\n'
-            b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-
-    cap.release()
+    ctx.obj["codec"] = codec
+    ctx.obj["quality"] = quality
+    ctx.obj["max_fps"] = max_fps
+
+
+
+class Broadcaster():
+    """1 つのスレッドでカメラを読んで加工し、最新のフレームだけを全クライアントに配る
+
+    クライアントは自分の準備ができた時点の最新フレームを受け取るので、遅い
+    クライアントの分は古いフレームが読み飛ばされ、遅延が溜まらない
+    """
+
+    def __init__(
+            self, camera_id, process, max_fps=0., retry_interval=0.5, reopen_after=10):
+        self._camera_id = camera_id
+        self._process = process
+        self._min_interval = 1. / max_fps if max_fps > 0 else 0.
+        self._retry_interval = retry_interval
+        self._reopen_after = reopen_after
+        self._cond = threading.Condition()
+        self._frame = None
+        self._seq = 0
+        self._thread = None
+
+    def _start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        cap = cv2.VideoCapture(self._camera_id)
+        failures = 0
+        last = 0.
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                # 読めないときは空回りせずに待ち、続くようならカメラを開き直す
+                failures += 1
+                time.sleep(self._retry_interval)
+                if failures >= self._reopen_after:
+                    print(f"reopen camera {self._camera_id}")
+                    cap.release()
+                    cap = cv2.VideoCapture(self._camera_id)
+                    failures = 0
+                continue
+            failures = 0
+            # 読み込みはカメラの速度で続け、上限を超える分は加工せずに捨てる
+            now = time.monotonic()
+            if now - last < self._min_interval:
+                continue
+            last = now
+
+            data = self._process(frame)
+            with self._cond:
+                self._frame = data
+                self._seq += 1
+                self._cond.notify_all()
+
+    def frames(self):
+        self._start()
+        seq = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._seq != seq)
+                seq = self._seq
+                data = self._frame
+            yield data
+
+
+class FugashyRenderer():
+    """エッジを縁取りした画像を作って符号化する。バッファはフレームサイズごとに使い回す"""
+
+    def __init__(self, codec="png", quality=80):
+        self.mimetype, self._ext, alpha = CODECS[codec]
+        # ラベル 0: 背景, 1: 縁 (out のみ), 2: 芯 (core) の色
+        if alpha:
+            self._palette = np.array(
+                    [(0, 0, 0, 0), (0, 0, 0, 255), (255, 255, 255, 255)], dtype=np.uint8)
+        else:
+            # JPEG は透過できないので背景をクロマキー用の緑にする
+            self._palette = np.array(
+                    [(0, 255, 0), (0, 0, 0), (255, 255, 255)], dtype=np.uint8)
+        self._params = {
+            "jpeg": [cv2.IMWRITE_JPEG_QUALITY, quality],
+            "webp": [cv2.IMWRITE_WEBP_QUALITY, quality],
+            # この画像は単色の塊ばかりなので RLE が速く、圧縮率もそれなりに出る
+            "png": [cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE],
+        }[codec]
+        self._kernel = np.ones((3, 3), np.uint8)
+        self._shape = None
+
+    def _allocate(self, h, w):
+        self._shape = (h, w)
+        self._gray = np.empty((h, w), np.uint8)
+        self._edges = np.empty((h, w), np.uint8)
+        self._core = np.empty((h, w), np.uint8)
+        self._out = np.empty((h, w), np.uint8)
+        self._label = np.empty((h, w), np.uint8)
+        self._image = np.empty((h, w, self._palette.shape[1]), np.uint8)
+
+    def __call__(self, frame):
+        h, w = frame.shape[:2]
+        if self._shape != (h, w):
+            self._allocate(h, w)
+
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        cv2.GaussianBlur(self._gray, (5, 5), 0, dst=self._gray)
+        cv2.Canny(self._gray, threshold1=50, threshold2=150, edges=self._edges)
+
+        cv2.dilate(self._edges, self._kernel, dst=self._core, iterations=4)
+        cv2.dilate(self._core, self._kernel, dst=self._out, iterations=4)
+
+        # core は out に含まれるので (out > 0) + (core > 0) がそのままラベルになる
+        cv2.threshold(self._out, 0, 1, cv2.THRESH_BINARY, dst=self._label)
+        cv2.threshold(self._core, 0, 1, cv2.THRESH_BINARY, dst=self._edges)
+        cv2.add(self._label, self._edges, dst=self._label)
+        np.take(self._palette, self._label, axis=0, out=self._image)
+
+        _, buffer = cv2.imencode(self._ext, self._image, self._params)
+        return buffer.tobytes()
+
+
+def _fugashy(broadcaster, mimetype):
+    header = f"--frame\r\nContent-Type: {mimetype}\r\n\r\n".encode()
+    for frame_bytes in broadcaster.frames():
+        yield header + frame_bytes + b'\r\n'
 
 
 @servers.command()
@@ -62,6 +166,9 @@ def _fugashy(camera_id):
 @click.pass_context
 def fugashy(ctx, camera_id):
     app = Flask(__name__)
+    renderer = FugashyRenderer(ctx.obj["codec"], ctx.obj["quality"])
+    # カメラの読み込みと加工は視聴者の数によらず 1 回だけ行う
+    broadcaster = Broadcaster(camera_id, renderer, ctx.obj["max_fps"])
 
     @app.route("/")
     def index():
@@ -70,6 +177,6 @@ def fugashy(ctx, camera_id):
     @app.route("/video_feed")
     def video_feed():
         return Response(
-                _fugashy(camera_id),
+                _fugashy(broadcaster, renderer.mimetype),
                 mimetype='multipart/x-mixed-replace; boundary=frame')
-    app.run(host=ctx.obj["host"], port=ctx.obj["port"])
+    app.run(host=ctx.obj["host"], port=ctx.obj["port"], threaded=True)
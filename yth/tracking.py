@@ -0,0 +1,221 @@
+import numpy as np
+
+from . import result_io
+
+
+def iou_matrix(a, b):
+    """(n, 4) と (m, 4) の矩形同士の IoU を (n, m) で返す"""
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.divide(
+            inter, union, out=np.zeros_like(inter, dtype=np.float64),
+            where=union > 0)
+
+
+def boxes_of(records):
+    return np.stack(
+            [records["x1"], records["y1"], records["x2"], records["y2"]],
+            axis=1)
+
+
+def centers_of(records):
+    return np.stack(
+            [(records["x1"] + records["x2"]) / 2, (records["y1"] + records["y2"]) / 2],
+            axis=1)
+
+
+class IoUTracker():
+    """前回の検出と重なるか、十分近い同じクラスの矩形に同じ ID を振る
+
+    キーフレームの間隔が空くと動いた物体は IoU が 0 になるので、中心間の距離が
+    矩形の大きさ × max_speed × 経過フレーム数 以内で大きさが近いものも対応付ける。
+    位置は最後に見えたときの速度で進めてから比べる。
+
+    見失ったトラックは max_age 回のキーフレームまで残し、その間は速度から推定した
+    矩形を返す。1 回の検出漏れでトラックが切れず、前後のフレームも覆われる
+    """
+
+    def __init__(self, iou_threshold=0.3, max_speed=0.5, max_scale_change=2., max_age=1):
+        self._iou_threshold = iou_threshold
+        self._max_speed = max_speed
+        self._max_scale_change = max_scale_change
+        self._max_age = max_age
+        self._next_id = 0
+        self._reset()
+
+    def _reset(self):
+        # トラックごとに最後に見えたときの検出、1 フレームあたりの移動量、見失った回数
+        self._tracks = np.zeros(0, dtype=result_io.DTYPE)
+        self._velocity = np.zeros((0, 4))
+        self._misses = np.zeros(0, dtype=np.int32)
+
+    def _predict(self, frame_id):
+        gap = frame_id - self._tracks["frame_id"].astype(np.int64)
+        return boxes_of(self._tracks) + self._velocity * gap[:, None], gap
+
+    def _candidates(self, frame_id, records):
+        prev_boxes, gap = self._predict(frame_id)
+        gap = np.maximum(gap, 1)
+        boxes = boxes_of(records)
+        iou = iou_matrix(prev_boxes, boxes)
+
+        sizes = np.maximum(prev_boxes[:, 2] - prev_boxes[:, 0], prev_boxes[:, 3] - prev_boxes[:, 1])
+        prev_centers = (prev_boxes[:, :2] + prev_boxes[:, 2:]) / 2
+        distance = np.linalg.norm(
+                prev_centers[:, None, :] - centers_of(records)[None, :, :], axis=2)
+        distance = distance / np.maximum(sizes, 1.)[:, None]
+        area_prev = np.prod(prev_boxes[:, 2:] - prev_boxes[:, :2], axis=1)
+        area = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+        ratio = np.maximum(area_prev, 1.)[:, None] / np.maximum(area, 1.)[None, :]
+        near = (distance <= self._max_speed * gap[:, None]) \
+            & (ratio <= self._max_scale_change ** 2) & (ratio >= self._max_scale_change ** -2)
+
+        ok = (iou >= self._iou_threshold) | near
+        ok &= self._tracks["cls"][:, None] == records["cls"][None, :]
+        pairs = np.argwhere(ok)
+        # IoU の高い順、同じなら近い順に採用する
+        order = np.lexsort((
+            distance[pairs[:, 0], pairs[:, 1]], -iou[pairs[:, 0], pairs[:, 1]]))
+        return pairs[order]
+
+    def update(self, frame_id, records, cut=False):
+        """frame_id の検出に ID を振り、見失っている間のトラックの推定矩形を加えて返す
+
+        シーンが切り替わった場合 (cut) はそれまでのトラックを引き継がない
+        """
+        if cut:
+            self._reset()
+        ids = np.full(len(records), -1, dtype=np.int32)
+        matched = np.full(len(records), -1)
+        if len(self._tracks) and len(records):
+            used = set()
+            for i, j in self._candidates(frame_id, records):
+                if i in used or ids[j] >= 0:
+                    continue
+                used.add(i)
+                ids[j] = self._tracks["tracking_id"][i]
+                matched[j] = i
+
+        new = ids < 0
+        ids[new] = np.arange(self._next_id, self._next_id + new.sum())
+        self._next_id += int(new.sum())
+
+        records = records.copy()
+        records["tracking_id"] = ids
+        velocity = np.zeros((len(records), 4))
+        found = matched >= 0
+        if found.any():
+            last = self._tracks[matched[found]]
+            gap = np.maximum(frame_id - last["frame_id"].astype(np.int64), 1)
+            velocity[found] = (boxes_of(records[found]) - boxes_of(last)) / gap[:, None]
+
+        lost = np.setdiff1d(np.arange(len(self._tracks)), matched[found])
+        lost = lost[self._misses[lost] < self._max_age]
+        predicted = self._tracks[lost].copy()
+        predicted["frame_id"] = frame_id
+        boxes, _ = self._predict(frame_id)
+        for k, name in enumerate(["x1", "y1", "x2", "y2"]):
+            predicted[name] = boxes[lost, k]
+
+        self._tracks = np.concatenate([records, self._tracks[lost]])
+        self._velocity = np.concatenate([velocity, self._velocity[lost]])
+        self._misses = np.concatenate([
+            np.zeros(len(records), dtype=np.int32), self._misses[lost] + 1])
+        return np.concatenate([records, predicted])
+
+
+def _hold(records, frames):
+    # records をそのまま各フレームに複製する (フレーム順)
+    held = np.tile(records, len(frames))
+    held["frame_id"] = np.repeat(frames, len(records))
+    return held
+
+
+def interpolate(prev_frame, prev, next_frame, following, cut=False):
+    """2 つのキーフレームの間のフレームの矩形を補う
+
+    両方にある ID は線形補間し、片方にしかない ID はその矩形を保持する。
+    シーンが切り替わった場合 (cut) は前のキーフレームの矩形を保持するだけにする
+    """
+    frames = np.arange(prev_frame + 1, next_frame, dtype=np.int32)
+    if len(frames) == 0:
+        return np.zeros(0, dtype=result_io.DTYPE)
+    if cut:
+        return _hold(prev, frames)
+
+    _, i0, i1 = np.intersect1d(
+            prev["tracking_id"], following["tracking_id"], return_indices=True)
+    only_prev = np.setdiff1d(np.arange(len(prev)), i0)
+    only_next = np.setdiff1d(np.arange(len(following)), i1)
+
+    # 対応付けられなかった矩形も、クラスごとに前後 1 つずつしかなければ
+    # 同じ物体とみなして補間する (両方を保持すると間の位置が覆われない)
+    pair_prev, pair_next = list(), list()
+    for cls in np.intersect1d(prev["cls"][only_prev], following["cls"][only_next]):
+        p = only_prev[prev["cls"][only_prev] == cls]
+        n = only_next[following["cls"][only_next] == cls]
+        if len(p) == 1 and len(n) == 1:
+            pair_prev.append(p[0])
+            pair_next.append(n[0])
+    i0 = np.concatenate([i0, np.asarray(pair_prev, dtype=i0.dtype)])
+    i1 = np.concatenate([i1, np.asarray(pair_next, dtype=i1.dtype)])
+    only_prev = np.setdiff1d(only_prev, pair_prev)
+    only_next = np.setdiff1d(only_next, pair_next)
+
+    t = ((frames - prev_frame) / (next_frame - prev_frame))[:, None]
+    matched = _hold(prev[i0], frames)
+    for name in ["conf", "x1", "y1", "x2", "y2"]:
+        v0 = prev[name][i0][None, :]
+        v1 = following[name][i1][None, :]
+        matched[name] = (v0 + t * (v1 - v0)).ravel()
+
+    parts = np.concatenate([
+        matched,
+        _hold(prev[only_prev], frames),
+        _hold(following[only_next], frames),
+        ])
+    return parts[np.argsort(parts["frame_id"], kind="stable")]
+
+
+class KeyframeInterpolator():
+    """キーフレームの検出結果を受け取り、間のフレームを補って書き出す"""
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._prev_frame = None
+        self._prev = None
+        # 最後のキーフレームの ID ごとの 1 フレームあたりの移動量
+        self._velocity = np.zeros((0, 4))
+
+    def add(self, frame_id, records, cut=False):
+        velocity = np.zeros((len(records), 4))
+        if self._prev is not None:
+            self._writer.append(interpolate(
+                self._prev_frame, self._prev, frame_id, records, cut))
+            if not cut:
+                _, i0, i1 = np.intersect1d(
+                        self._prev["tracking_id"], records["tracking_id"], return_indices=True)
+                velocity[i1] = (boxes_of(records[i1]) - boxes_of(self._prev[i0])) \
+                    / (frame_id - self._prev_frame)
+        self._writer.append(records)
+        self._prev_frame = frame_id
+        self._prev = records
+        self._velocity = velocity
+
+    def finish(self, frame_num):
+        # 最後のキーフレーム以降は直前の速度で矩形を進める
+        if self._prev is None:
+            return
+        frames = np.arange(self._prev_frame + 1, frame_num, dtype=np.int32)
+        held = _hold(self._prev, frames)
+        steps = np.repeat(frames - self._prev_frame, len(self._prev))[:, None]
+        boxes = boxes_of(held) + np.tile(self._velocity, (len(frames), 1)) * steps
+        for k, name in enumerate(["x1", "y1", "x2", "y2"]):
+            held[name] = boxes[:, k]
+        self._writer.append(held)
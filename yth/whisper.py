@@ -1,24 +1,236 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
 import whisper as whisp
-import json
+
 import click
 import ffmpeg
-import torch
+import numpy as np
 import pandas as pd
+from tqdm import tqdm
+
+from .cache import TranscriptCache
+from .devices import configure_threads, device_options, select_device
+from . import media
+
 
+SAMPLE_RATE = whisp.audio.SAMPLE_RATE
+SEGMENT_COLUMNS = [
+        "id", "seek", "start", "end", "text", "tokens", "temperature",
+        "avg_logprob", "compression_ratio", "no_speech_prob"]
 
-def _extract_audio_as_file(input_videopath, track_id, audio_filepath):
-    probe = ffmpeg.probe(input_videopath)
-    audio_streams = [
-            stream for stream in probe["streams"]
-            if stream["codec_type"] == "audio"
-            ]
-    (
+
+def _load_audio(input_videopath, track_id):
+    """指定トラックを ffmpeg で一度だけデコードし、16 kHz モノラル float32 の配列にする"""
+    out, _ = (
         ffmpeg
         .input(input_videopath)
-        .output(audio_filepath, map=f"0:a:{track_id}")
-        .run()
+        .output(
+            "pipe:",
+            map=f"0:a:{track_id}",
+            format="f32le",
+            acodec="pcm_f32le",
+            ac=1,
+            ar=SAMPLE_RATE)
+        .global_args("-loglevel", "error")
+        .run(capture_stdout=True)
     )
+    return np.frombuffer(out, np.float32)
+
+
+def _speech_ranges(audio, min_silence_len, silence_thresh, block_seconds=10):
+    # デコード済みの音声に edit filter_silence と同じ無音判定をかける
+    detector = media.SilenceDetector(SAMPLE_RATE, 1, min_silence_len, silence_thresh)
+    block = SAMPLE_RATE * block_seconds
+    for i in range(0, len(audio), block):
+        pcm = np.clip(audio[i:i + block] * 32768, -32768, 32767).astype(np.int16)
+        detector.feed(pcm.tobytes())
+    return media.non_silent_ranges(detector, SAMPLE_RATE, min_silence_len)
+
+
+def _window_energies(audio, window):
+    # window サンプルごとの平均二乗
+    num = len(audio) // window
+    return np.square(audio[:num * window].reshape(num, window)).mean(axis=1)
+
+
+def _plan_chunks(audio, speech_ranges, max_chunk_seconds, window_seconds=0.1):
+    """発話区間を max_chunk_seconds 以下の塊に分ける (秒)。0 なら分けない
+
+    長い区間は max_chunk_seconds の半分から max_chunk_seconds までのうち、
+    最も静かな window_seconds の窓の中央で切り、単語の途中で切らないようにする
+    """
+    if max_chunk_seconds <= 0:
+        return [(float(start), float(end)) for start, end in speech_ranges]
+    energies = _window_energies(audio, int(SAMPLE_RATE * window_seconds))
+    chunks = list()
+    for start, end in speech_ranges:
+        while end - start > max_chunk_seconds:
+            lo = int((start + max_chunk_seconds / 2) / window_seconds)
+            hi = min(int((start + max_chunk_seconds) / window_seconds), len(energies))
+            if lo < hi:
+                cut = (lo + int(np.argmin(energies[lo:hi])) + 0.5) * window_seconds
+            else:
+                cut = start + max_chunk_seconds
+            chunks.append((float(start), float(cut)))
+            start = cut
+        chunks.append((float(start), float(end)))
+    return chunks
+
+
+# ワーカープロセスごとに 1 つだけ読み込むモデル
+_model = None
+_fp16 = False
+
+
+def _init_worker(model_name, device, num_threads):
+    global _model, _fp16
+    configure_threads(num_threads)
+    _model = whisp.load_model(model_name, device=device)
+    _fp16 = device == "cuda"
+
+
+def _transcribe_chunk(audio, key=None, meta=None, prompt=None):
+    result = _model.transcribe(
+            audio, verbose=None, fp16=_fp16, language="ja", initial_prompt=prompt)
+    segments = [
+        {k: v for k, v in segment.items() if k != "id"}
+        for segment in result["segments"]]
+    # 中断しても終わったチャンクは残るよう、ワーカー側ですぐ保存する
+    if key is not None:
+        TranscriptCache().put(key, segments, meta)
+    return segments
+
+
+def _shift(segments, start):
+    # チャンク内の時刻を動画全体の時刻に直す
+    for segment in segments:
+        segment["start"] += start
+        segment["end"] += start
+        for word in segment.get("words", []):
+            word["start"] += start
+            word["end"] += start
+    return segments
+
 
+class SegmentWriter():
+    """セグメントを出来た順に CSV へ追記する。長い処理でも tail で進捗を追える"""
+
+    def __init__(self, path):
+        self._f = open(path, "w", encoding="utf-8", newline="")
+        self._next_id = 0
+
+    def write(self, segments):
+        ids = range(self._next_id, self._next_id + len(segments))
+        segments = [dict(segment, id=i) for i, segment in zip(ids, segments)]
+        pd.DataFrame(segments, index=ids, columns=SEGMENT_COLUMNS).to_csv(
+                self._f, header=self._next_id == 0)
+        self._f.flush()
+        self._next_id += len(segments)
+        for segment in segments:
+            print(
+                f"[{whisp.utils.format_timestamp(segment['start'])} --> "
+                f"{whisp.utils.format_timestamp(segment['end'])}] {segment['text']}")
+
+    def close(self):
+        if self._next_id == 0:
+            # セグメントが 1 つもなくても列名だけは書いておく
+            pd.DataFrame(columns=SEGMENT_COLUMNS).to_csv(self._f)
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _transcribe_chunks(
+        audio, chunks, writer, model_name, device, num_threads, jobs,
+        use_previous=False, meta=None):
+    cache = TranscriptCache()
+    params = dict(model_name=model_name, language="ja")
+    tasks = list()
+    reused = 0
+    for start, end in chunks:
+        chunk = audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)]
+        key = cache.key(chunk, params)
+        segments = cache.get(key) if use_previous else None
+        reused += segments is not None
+        tasks.append((start, chunk, key, segments))
+    if use_previous:
+        print(f"reuse {reused} / {len(chunks)} chunks")
+    meta = dict(meta or {}, params=params)
+
+    if jobs <= 1:
+        if reused < len(tasks):
+            _init_worker(model_name, device, num_threads)
+        for start, chunk, key, segments in tqdm(tasks):
+            if segments is None:
+                segments = _transcribe_chunk(chunk, key, meta)
+            writer.write(_shift(segments, start))
+        return
+
+    # CUDA を子プロセスで使えるよう fork ではなく spawn で起動する
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_name, device, num_threads)) as executor:
+        futures = [
+            None if segments is not None
+            else executor.submit(_transcribe_chunk, chunk, key, meta)
+            for _, chunk, key, segments in tasks]
+        # 終わった順ではなく時刻順に書き出す
+        for (start, _, _, segments), future in tqdm(list(zip(tasks, futures))):
+            if future is not None:
+                segments = future.result()
+            writer.write(_shift(segments, start))
+
+
+def _transcribe_stream(
+        audio, writer, window_seconds, model_name, device, num_threads,
+        use_previous=False, meta=None, prompt_segments=8):
+    """--vad なしの文字起こし。window_seconds ずつ順に文字起こしし、終わった分から書き出す
+
+    窓の最後のセグメントは窓の端で切れているかもしれないので捨て、次の窓は
+    残したセグメントの終わりから始める。直前のセグメントの文字列を
+    initial_prompt に渡し、1 回で文字起こしする場合と同じく文脈をつなぐ。
+    窓ごとにチェックポイントを置くので、中断しても終わった窓の続きから再開できる
+    """
+    cache = TranscriptCache()
+    params = dict(model_name=model_name, language="ja")
+    meta = dict(meta or {}, params=params)
+    duration = len(audio) / SAMPLE_RATE
+    start = 0.
+    prompt = None
+    reused = 0
+    with tqdm(total=round(duration), unit="s") as bar:
+        while start < duration:
+            end = min(start + window_seconds, duration)
+            window = audio[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)]
+            # 窓の結果は前の窓の文字列にもよるのでキーに含める
+            key = cache.key(window, dict(params, prompt=prompt))
+            segments = cache.get(key) if use_previous else None
+            if segments is None:
+                if _model is None:
+                    _init_worker(model_name, device, num_threads)
+                segments = _transcribe_chunk(window, key, meta, prompt)
+            else:
+                reused += 1
+            if end < duration and len(segments) > 1 \
+                    and segments[-2]["end"] > window_seconds / 2:
+                segments = segments[:-1]
+                next_start = start + segments[-1]["end"]
+            else:
+                next_start = end
+            writer.write(_shift(segments, start))
+            if segments:
+                prompt = "".join(segment["text"] for segment in segments[-prompt_segments:])
+            bar.update(round(next_start) - round(start))
+            start = next_start
+    if use_previous:
+        print(f"reused {reused} windows")
 
 
 @click.group()
@@ -30,31 +242,55 @@ def whisper():
 @click.argument("input_videopath", type=str)
 @click.option("--track-id", type=int, default=1)
 @click.option("--model-name", type=str, default="turbo")
-@click.option("--use-previous", is_flag=True, default=False)
-def transcribe(input_videopath, track_id, model_name, use_previous):
-    if not torch.backends.mps.is_available():
-        print("MPS is not available...")
-        return
-    audio_filepath = "/tmp/audio.mp3"
-    _extract_audio_as_file(
-            input_videopath, track_id, audio_filepath)
-
-    model = whisp.load_model(model_name)
-    result = model.transcribe(
-            audio_filepath,
-            verbose=True,
-            fp16=False,
-            language="ja")
-
-    f = open('/tmp/transcription.json', 'w', encoding='UTF-8')
-    f.write(json.dumps(result, sort_keys=True, indent=4, ensure_ascii=False))
-    f.close()
-    with open("/tmp/transcription.json", "r") as f:
-        trans = json.load(f)
-
-    df = pd.DataFrame().from_dict(trans["segments"])
-    df.to_csv("/tmp/segments.csv")
-
+@click.option(
+    "--use-previous", is_flag=True, default=False,
+    help="reuse chunks or windows checkpointed by earlier runs, e.g. after a crash or an edit")
+@device_options
+@click.option(
+    "--output-path", type=str, default="/tmp/segments.csv",
+    help="segments CSV, appended as chunks finish")
+@click.option(
+    "--vad", is_flag=True, default=False,
+    help="split the track at silences and transcribe only the speech chunks")
+@click.option("--jobs", type=int, default=1, help="worker processes for --vad chunks, each loads the model once")
+@click.option(
+    "--window-seconds", type=float, default=120.,
+    help="without --vad, audio transcribed per call, segments are written after each window")
+@click.option("--min-silence-len", type=int, default=1000, help="ms, for --vad")
+@click.option("--silence-thresh", type=int, default=-40, help="dBFS, for --vad")
+@click.option("--padding", type=int, default=200, help="ms added around each speech range, for --vad")
+@click.option(
+    "--max-chunk-seconds", type=float, default=300.,
+    help="for --vad, longer speech ranges are split at their quietest point, 0 disables")
+def transcribe(
+        input_videopath, track_id, model_name, use_previous,
+        device, num_threads, output_path, vad, jobs, window_seconds,
+        min_silence_len, silence_thresh, padding, max_chunk_seconds):
+    # whisper は MPS に対応していない演算があるので cuda か cpu を使う
+    device = select_device(device, candidates=("cuda",))
+    configure_threads(num_threads)
 
+    audio = _load_audio(input_videopath, track_id)
+    duration = len(audio) / SAMPLE_RATE
+    meta = dict(video_path=os.path.abspath(input_videopath), track_id=track_id)
+    if not vad:
+        # 前の窓の文字列を引き継ぎながら先頭から順に文字起こしする
+        print(f"{duration:.1f} s, {window_seconds:.0f} s per window")
+        with SegmentWriter(output_path) as writer:
+            _transcribe_stream(
+                    audio, writer, window_seconds, model_name, device, num_threads,
+                    use_previous, meta)
+        print(f"output segments to {output_path}")
+        return
 
+    ranges = media.postprocess_intervals(
+            _speech_ranges(audio, min_silence_len, silence_thresh), padding)
+    ranges = [(start, min(end, duration)) for start, end in ranges]
+    chunks = _plan_chunks(audio, ranges, max_chunk_seconds)
+    print(f"{len(chunks)} chunks, {sum(e - s for s, e in chunks):.1f} / {duration:.1f} s")
 
+    with SegmentWriter(output_path) as writer:
+        _transcribe_chunks(
+                audio, chunks, writer, model_name, device, num_threads, jobs,
+                use_previous, meta)
+    print(f"output segments to {output_path}")
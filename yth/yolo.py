@@ -1,14 +1,89 @@
-from collections import namedtuple
+import os
+import shutil
+import subprocess
+import tempfile
 
 import click
-import pandas as pd
+import cv2
+import ffmpeg
+import numpy as np
 
 from ultralytics import YOLO
-import torch
 
+from . import result_io
+from .cache import DetectionCache, cache_dir, file_hash
+from .devices import configure_threads, device_options, select_device
+from .tracking import IoUTracker, KeyframeInterpolator
 
-_COLUMN_NAMES = [
-    "frame_id", "tracking_id", "cls", "conf", "x1", "y1", "x2", "y2"]
+
+def _boxes_to_rows(frame_id, boxes, scale=(1., 1.)):
+    # (x1, y1, x2, y2, [id,] conf, cls) をまとめて numpy に移す
+    # scale は縮小デコードした座標を元の解像度に戻す倍率 (x, y)
+    data = boxes.data.cpu().numpy()
+    rows = np.empty(len(data), dtype=result_io.DTYPE)
+    rows["frame_id"] = frame_id
+    rows["tracking_id"] = data[:, 4] if boxes.is_track else -1
+    rows["cls"] = data[:, -1]
+    rows["conf"] = data[:, -2]
+    for i, name in enumerate(["x1", "y1", "x2", "y2"]):
+        rows[name] = data[:, i] * scale[i % 2]
+    return rows
+
+
+def _video_size(input_filepath):
+    video = cv2.VideoCapture(input_filepath)
+    size = (
+        int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    video.release()
+    return size
+
+
+def _read_frames(input_filepath, decode_size=None):
+    """BGR のフレームを順に返す。decode_size を与えると ffmpeg で縮小してデコードする"""
+    if decode_size is None:
+        video = cv2.VideoCapture(input_filepath)
+        while True:
+            ret, img = video.read()
+            if not ret:
+                break
+            yield img
+        video.release()
+        return
+
+    width, height = decode_size
+    cmd = (
+        ffmpeg
+        .input(input_filepath)
+        .filter("scale", width, height)
+        # 重複・欠落フレームを足し引きせず、デコードしたフレームをそのまま出して
+        # cv2 で読む場合と frame_id を揃える
+        .output("pipe:", format="rawvideo", pix_fmt="bgr24", fps_mode="passthrough")
+        .global_args("-loglevel", "error")
+        .compile()
+    )
+    # エラー内容を失敗時に表示できるよう stderr はファイルに受ける
+    with tempfile.TemporaryFile() as log:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log)
+        frame_bytes = width * height * 3
+        finished = False
+        try:
+            while True:
+                buffer = process.stdout.read(frame_bytes)
+                if len(buffer) < frame_bytes:
+                    break
+                yield np.frombuffer(buffer, np.uint8).reshape(height, width, 3)
+            finished = True
+        finally:
+            # 途中で読むのをやめた場合は ffmpeg を止める
+            if not finished:
+                process.kill()
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            log.seek(0)
+            message = log.read().decode(errors="replace").strip()
+            raise RuntimeError(f"ffmpeg exited with code {returncode}: {message}")
 
 
 @click.group()
@@ -16,38 +91,261 @@ def yolo():
     pass
 
 
+def check_precision(export, precision):
+    # int8 の量子化は OpenVINO への変換時にしか効かず、そのままでは fp32 で動いてしまう
+    if precision == "int8" and export != "openvino":
+        raise click.BadParameter(
+            "int8 needs --export openvino", param_hint="--precision")
+
+
+def _export_model(model, export, precision, batch, device):
+    """変換済みのモデルをキャッシュに置き、同じモデル・精度・バッチなら使い回す
+
+    変換は一時ディレクトリで行ってから rename するので、並列のワーカーが
+    同時に変換しても互いの書きかけを読まない
+    """
+    src = model.ckpt_path or model.model_name
+    stem = os.path.splitext(os.path.basename(src))[0]
+    key = f"{stem}-{file_hash(src)[:12]}-{precision}-b{batch}"
+    models_dir = cache_dir("models")
+    target = os.path.join(
+            models_dir, f"{key}.onnx" if export == "onnx" else f"{key}_openvino_model")
+    if os.path.exists(target):
+        return target
+
+    tmp_dir = tempfile.mkdtemp(prefix="export-", dir=models_dir)
+    try:
+        tmp_src = os.path.join(tmp_dir, os.path.basename(src))
+        shutil.copyfile(src, tmp_src)
+        path = YOLO(tmp_src).export(
+                format=export,
+                half=precision == "fp16",
+                int8=precision == "int8",
+                batch=batch,
+                device=device)
+        try:
+            os.rename(path, target)
+        except OSError:
+            # 他のワーカーが先に置いた場合はそちらを使う
+            if not os.path.exists(target):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return target
+
+
+def _load_model(model_name, device, export, precision, batch):
+    model = YOLO(model_name)
+    if export == "none":
+        return model
+    # CPU 向けに ONNX / OpenVINO へ変換したモデルを使う
+    path = _export_model(model, export, precision, batch, device)
+    return YOLO(path, task="detect")
+
+
+def _store(cache, input_filepath, params, output_filepath):
+    # キャッシュには常にバイナリ形式で置く
+    if result_io.is_binary(output_filepath):
+        return cache.put(input_filepath, params, output_filepath)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = os.path.join(tmp_dir, "results.npy")
+        result_io.copy(output_filepath, tmp_path)
+        return cache.put(input_filepath, params, tmp_path)
+
+
+def _predict_all(
+        model, input_filepath, writer, batch, predict_kwargs,
+        decode_size=None, scale=(1., 1.)):
+    if decode_size is None:
+        # stream=True で 1 フレームずつ結果を受け取り、保持しない
+        results = model.predict(
+                source=input_filepath, stream=True, batch=batch, **predict_kwargs)
+        for frame_id, r in enumerate(results):
+            writer.append(_boxes_to_rows(frame_id, r.boxes))
+        return
+
+    frame_id = 0
+    images = list()
+
+    def detect():
+        nonlocal frame_id
+        for r in model.predict(source=images, stream=False, **predict_kwargs):
+            writer.append(_boxes_to_rows(frame_id, r.boxes, scale))
+            frame_id += 1
+        images.clear()
+
+    for img in _read_frames(input_filepath, decode_size):
+        images.append(img)
+        if len(images) >= batch:
+            detect()
+    if images:
+        detect()
+
+
+def _scene_thumbnail(img):
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (64, 36), interpolation=cv2.INTER_AREA)
+
+
+def _predict_tracked(
+        model, input_filepath, writer, batch, predict_kwargs,
+        detect_every, scene_threshold, decode_size=None, scale=(1., 1.)):
+    # detect_every フレームごと、またはシーンが変わったフレームだけ検出し、
+    # 間のフレームは追跡結果から補間する
+    tracker = IoUTracker()
+    interpolator = KeyframeInterpolator(writer)
+    keyframes = list()
+
+    def detect():
+        images = [img for _, img, _ in keyframes]
+        results = model.predict(source=images, stream=False, **predict_kwargs)
+        for (frame_id, _, cut), r in zip(keyframes, results):
+            records = tracker.update(frame_id, _boxes_to_rows(frame_id, r.boxes, scale), cut)
+            interpolator.add(frame_id, records, cut)
+        keyframes.clear()
+
+    frame_id = 0
+    prev_thumbnail = None
+    for img in _read_frames(input_filepath, decode_size):
+        thumbnail = _scene_thumbnail(img)
+        cut = prev_thumbnail is not None and scene_threshold > 0 \
+            and cv2.absdiff(thumbnail, prev_thumbnail).mean() > scene_threshold
+        prev_thumbnail = thumbnail
+        if cut or frame_id % detect_every == 0:
+            keyframes.append((frame_id, img, cut))
+            if len(keyframes) >= batch:
+                detect()
+        frame_id += 1
+    if keyframes:
+        detect()
+    interpolator.finish(frame_id)
+
+
+class Detector():
+    """モデルを一度だけ読み込み、複数の動画の検出に使い回す"""
+
+    def __init__(
+            self,
+            model_name="yolov8s.pt",
+            device="auto",
+            export="none",
+            precision="auto",
+            batch=8,
+            track=False,
+            detect_every=1,
+            scene_threshold=30.,
+            decode_width=0):
+        check_precision(export, precision)
+        self.device = select_device(device)
+        if precision == "auto":
+            precision = "fp16" if self.device == "cuda" else "fp32"
+        self.model_name = model_name
+        self.export = export
+        self.precision = precision
+        self.batch = batch
+        self.track = track or detect_every > 1
+        self.detect_every = detect_every
+        self.scene_threshold = scene_threshold
+        self.decode_width = decode_width
+        self.model = None
+
+    def load(self):
+        # キャッシュに当たった場合は読み込まずに済むよう、必要になってから読む
+        if self.model is None:
+            self.model = _load_model(
+                    self.model_name, self.device, self.export, self.precision, self.batch)
+        return self.model
+
+    def run(self, input_filepath, output_filepath, chunk_rows=100000, cache=None):
+        params = dict(model_name=self.model_name, export=self.export, precision=self.precision)
+        if self.track:
+            params.update(detect_every=self.detect_every, scene_threshold=self.scene_threshold)
+
+        width, height = _video_size(input_filepath)
+        meta = dict(source_size=[width, height])
+        decode_size = None
+        scale = (1., 1.)
+        if 0 < self.decode_width < width:
+            decode_height = max(2, round(height * self.decode_width / width / 2) * 2)
+            decode_size = (self.decode_width, decode_height)
+            scale = (width / self.decode_width, height / decode_height)
+            meta.update(decode_size=list(decode_size), scale=list(scale))
+            params.update(decode_width=self.decode_width)
+            print(f"decode at {self.decode_width}x{decode_height}")
+        if cache is not None:
+            cached = cache.get(input_filepath, params)
+            if cached is not None:
+                result_io.copy(cached, output_filepath)
+                print(f"use cached result {cached}")
+                return output_filepath
+
+        model = self.load()
+        predict_kwargs = dict(
+                show=False,
+                save=False,
+                verbose=False,
+                half=self.precision == "fp16" and self.export == "none",
+                device=self.device)
+        with result_io.Writer(output_filepath, chunk_rows, meta) as writer:
+            if self.track:
+                _predict_tracked(
+                        model, input_filepath, writer, self.batch, predict_kwargs,
+                        self.detect_every, self.scene_threshold, decode_size, scale)
+            else:
+                _predict_all(
+                        model, input_filepath, writer, self.batch, predict_kwargs,
+                        decode_size, scale)
+        if cache is not None:
+            _store(cache, input_filepath, params, output_filepath)
+        return output_filepath
+
+
 @yolo.command()
 @click.argument("input_filepath", type=str)
-@click.option("--output_filepath", type=str, default="/tmp/blindpy-yolo-results.txt")
+@click.option(
+    "--output_filepath", type=str, default="/tmp/blindpy-yolo-results.npy",
+    help="*.csv / *.txt are written as CSV, anything else as binary .npy")
 @click.option("--model-name", type=str, default="yolov8s.pt")
+@click.option("--batch", type=int, default=8, help="frames per inference batch")
+@click.option("--chunk-rows", type=int, default=100000, help="rows buffered before writing")
+@device_options
+@click.option("--export", type=click.Choice(["none", "onnx", "openvino"]), default="none")
+@click.option(
+    "--precision", type=click.Choice(["auto", "fp32", "fp16", "int8"]), default="auto",
+    help="auto: fp16 on cuda, fp32 elsewhere")
+@click.option(
+    "--cache/--no-cache", "use_cache", default=True,
+    help="reuse detections cached for the same video, model and parameters")
+@click.option("--track", is_flag=True, default=False, help="assign tracking ids across frames")
+@click.option(
+    "--detect-every", type=int, default=1,
+    help="run the detector every N frames and interpolate tracked boxes in between")
+@click.option(
+    "--scene-threshold", type=float, default=30.,
+    help="mean abs diff of thumbnails (0-255) that forces detection, 0 disables")
+@click.option(
+    "--decode-width", type=int, default=0,
+    help="decode frames downscaled to this width with ffmpeg, 0 decodes at full size")
 def predict(
         input_filepath,
         output_filepath,
-        model_name):
-    if not torch.backends.mps.is_available():
-        print("MPS is not available...")
-        return
-
-    model = YOLO(model_name)
-
-    results = model(source=input_filepath, show=False, save=False, device="mps")
-    tuples = list()
-    Bbx = namedtuple("bbx", _COLUMN_NAMES)
-    bbxs = list()
-    for i, r in enumerate(results):
-        frame_id = i
-        for bbx in r.boxes:
-            tracking_id = bbx.id
-            cls = int(bbx.cls)
-            conf = float(bbx.conf)
-            xyxy = bbx.xyxy
-            x1 = float(xyxy[0,0])
-            y1 = float(xyxy[0,1])
-            x2 = float(xyxy[0,2])
-            y2 = float(xyxy[0,3])
-
-            bbxs.append(Bbx(frame_id, tracking_id, cls, conf, x1, y1, x2, y2))
-
-    df = pd.DataFrame(bbxs)
-    df.to_csv(output_filepath)
+        model_name,
+        batch,
+        chunk_rows,
+        device,
+        num_threads,
+        export,
+        precision,
+        use_cache,
+        track,
+        detect_every,
+        scene_threshold,
+        decode_width):
+    configure_threads(num_threads)
+    detector = Detector(
+            model_name, device, export, precision, batch,
+            track, detect_every, scene_threshold, decode_width)
+    print(f"device: {detector.device}, precision: {detector.precision}")
+    cache = DetectionCache() if use_cache else None
+    detector.run(input_filepath, output_filepath, chunk_rows, cache)
     print(f"output result to {output_filepath}")